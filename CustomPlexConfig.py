@@ -1,5 +1,15 @@
 import os
 import json
+import functools
+from dataclasses import dataclass, fields, replace
+
+from PlaylistPathRewriter import PlaylistPathRewriter
+
+DEFAULT_CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "PlexServerDefaultConfig.json")
+DEFAULT_PATH_REWRITE_RULES = ({"source": "**/Library/", "target": "{nvidia_shield_music_dir}Library/"},)
+STATE_FILE_SETTINGS = ("sync_manifest_file", "sync_journal_file", "free_file_sync_log_state_file", "track_index_file", "music_snapshot_file")
+TARGET_STATE_FILE_SETTINGS = ("sync_manifest_file", "sync_journal_file", "track_index_file") # they describe what is on a plex server, every target has its own
+SHARED_SETTINGS = ("playlists_dir", "free_file_sync_logs_dir", "free_file_sync_log_state_file", "targets", "target_name", "target_playlists_dir") # the targets can't override them
 
 """
 Class that reads a local json file which would store our local settings.
@@ -29,11 +39,158 @@ class CustomPlexConfig:
             return data
         else:
             return {}
+
+
+"""
+All the settings of a sync, with their defaults.
+The fields are named after the keys of the json config, except for playlists_dir which is built from the nvidia shield storage settings.
+Build it with load_settings(), and use dataclasses.replace() to apply command line overrides.
+When the playlists are pushed to several plex servers, get_target_settings() gives the settings of each of them.
+"""
+@dataclass(frozen=True)
+class PlexSyncSettings:
+    plex_url: str = None
+    plex_token: str = None
+    music_lib_section_name: str = None
+    sync_manifest_file: str = "PlaylistSyncManifest.json"
+    sync_journal_file: str = "PlaylistSyncJournal.jsonl" # what an interrupted sync already did, so the next one can resume it
+    force_sync_all_playlists: bool = False
+    incremental_update: bool = True # update existing playlists in place instead of deleting and recreating them
+    use_track_index: bool = True # build the playlists from the ratingKeys of their tracks instead of uploading converted m3u files
+    track_index_file: str = "PlexTrackIndex.sqlite"
+    validate_tracks: bool = True # check that the tracks of the playlists exist in the music tree before pushing them
+    music_snapshot_file: str = "MusicStorageSnapshot.pickle.gz"
+    music_snapshot_max_workers: int = 8
+    plex_api_max_workers: int = 4 # number of plex requests we allow to run at the same time
+    plex_api_max_retries: int = 3
+    plex_api_retry_backoff_seconds: float = 1.0
+    plex_api_max_pending: int = 32 # number of plex operations that can wait for a worker before the scan and the conversion are held back
+    conversion_max_workers: int = 4
+    watch_debounce_seconds: float = 15 # how long the playlists folder has to stay untouched before we sync a batch of changes
+    watch_poll_interval_seconds: float = 10
+    free_file_sync_logs_dir: str = "D:/Music/MusicBee/Playlists/Logs"
+    free_file_sync_log_state_file: str = "FreeFileSyncLogState.json"
+    nvidia_shield_storage_path: str = ""
+    nvidia_shield_music_relative_root_path: str = ""
+    nvidia_shield_playlists_relative_root_path: str = ""
+    nvidia_shield_id: str = None
+    path_rewrite_rules: list = DEFAULT_PATH_REWRITE_RULES # source and target prefixes of the track paths, ** matches any number of .. segments, the targets can use {nvidia_shield_music_dir} and {nvidia_shield_storage_root}
+    path_rewrite_cache_size: int = 200000
+    playlists_dir: str = ""
+    targets: list = () # settings of each plex server to push the playlists to, applied on top of these ones, see get_target_settings
+    target_name: str = "" # set by get_target_settings
+    target_playlists_dir: str = "" # where the converted playlists of a target go when it is not on the same storage as playlists_dir
+
+    @property
+    def unmodified_playlists_dir(self) -> str:
+        return self.playlists_dir + "Latest/"
+
+    @property
+    def converted_playlists_dir(self) -> str:
+        return (self.target_playlists_dir or self.playlists_dir) + "Converted/"
+
+    @property
+    def local_music_dir(self) -> str:
+        return self.nvidia_shield_storage_path + self.nvidia_shield_music_relative_root_path
+
+    @property
+    def nvidia_shield_storage_root(self) -> str:
+        return "/storage/%s/" % self.nvidia_shield_id
+
+    @property
+    def nvidia_shield_music_dir(self) -> str:
+        return self.nvidia_shield_storage_root + self.nvidia_shield_music_relative_root_path
+
+    @property
+    def plex_internal_converted_playlists_dir(self) -> str:
+        return self.nvidia_shield_storage_root + self.nvidia_shield_playlists_relative_root_path + "Converted/"
+
+    @functools.cached_property
+    def path_rewriter(self) -> PlaylistPathRewriter:
+        """ Built once, so that every playlist of the run shares its cache of translated paths, targets with the same rules share the same rewriter. """
+        rules = tuple((x["source"], x["target"].format(nvidia_shield_music_dir=self.nvidia_shield_music_dir, nvidia_shield_storage_root=self.nvidia_shield_storage_root))
+                      for x in self.path_rewrite_rules)
+        return get_path_rewriter(rules, self.path_rewrite_cache_size)
+
+"""
+Returns the rewriter of a set of (source prefix, target prefix) rules, there is only one per distinct set of rules.
+"""
+@functools.cache
+def get_path_rewriter(rules, cache_size) -> PlaylistPathRewriter:
+    return PlaylistPathRewriter(rules, cache_size)
+
+"""
+Returns the path of a state file for a target, e.g. PlaylistSyncManifest.json -> PlaylistSyncManifest.living_room.json.
+"""
+def get_target_state_file(path, target_name) -> str:
+    folder, file_name = os.path.split(path)
+    stem, dot, extensions = file_name.partition(".")
+    return os.path.join(folder, stem + "." + target_name + dot + extensions)
+
+"""
+Returns the settings of every plex server the playlists are pushed to, which is just <settings> if the config has no targets.
+Each target is a dict of settings applied on top of <settings>, with a name, e.g. {"name": "living_room", "plex_url": "...", "nvidia_shield_id": "..."}.
+The playlists tree is shared, it is scanned once for all targets, but the sync manifest, the journal and the track index of a target default to its own files.
+A target on another storage (nvidia_shield_storage_path...) gets its converted playlists and its music snapshot there.
+Raises a ValueError if a target is not valid.
+"""
+def get_target_settings(settings) -> list[PlexSyncSettings]:
+    if not settings.targets:
+        return [settings]
+
+    setting_names = {x.name for x in fields(PlexSyncSettings)}
+    targets_settings = []
+    for target in settings.targets:
+        target = dict(target)
+        target_name = target.pop("name", None)
+        if not target_name:
+            raise ValueError("Every target needs a name: %s" % target)
+        if target_name in (x.target_name for x in targets_settings):
+            raise ValueError("Two targets are named %s" % target_name)
+        for setting_name in target:
+            if setting_name not in setting_names or setting_name in SHARED_SETTINGS:
+                raise ValueError("Target %s can't set %s" % (target_name, setting_name))
+
+        target_settings = replace(settings, targets=(), target_name=target_name, **target)
+        state_files = {x: get_target_state_file(getattr(settings, x), target_name) for x in TARGET_STATE_FILE_SETTINGS if x not in target}
+        if target_settings.local_music_dir != settings.local_music_dir and "music_snapshot_file" not in target:
+            state_files["music_snapshot_file"] = get_target_state_file(settings.music_snapshot_file, target_name)
+        target_playlists_dir = target_settings.nvidia_shield_storage_path + target_settings.nvidia_shield_playlists_relative_root_path
+        if target_playlists_dir == settings.nvidia_shield_storage_path + settings.nvidia_shield_playlists_relative_root_path:
+            target_playlists_dir = ""
+        targets_settings.append(replace(target_settings, target_playlists_dir=target_playlists_dir, **state_files))
+
+    # the targets that share a converted playlists folder share the converted files, so they need the same rules
+    converted_playlists_signatures = dict()
+    for target_settings in targets_settings:
+        if target_settings.use_track_index:
+            continue # nothing is written to the converted playlists folder
+        signature = converted_playlists_signatures.setdefault(target_settings.converted_playlists_dir, target_settings.path_rewriter.signature)
+        if signature != target_settings.path_rewriter.signature:
+            raise ValueError("Target %s converts the playlists to %s with other rules than another target" % (target_settings.target_name, target_settings.converted_playlists_dir))
+    return targets_settings
+
+"""
+Reads the json config into a PlexSyncSettings, the file is only read the first time the settings of a path are asked for.
+The state files (sync manifest, journal, freefilesync log state, track index, music snapshot) are resolved relative to the folder of the config, the ones of the targets too.
+"""
+@functools.cache
+def load_settings(path=DEFAULT_CONFIG_FILE) -> PlexSyncSettings:
+    config = CustomPlexConfig(path)
+    settings = PlexSyncSettings(**{x.name: config.get(x.name) for x in fields(PlexSyncSettings) if config.get(x.name) is not None})
+
+    config_dir = os.path.dirname(os.path.abspath(path))
+    targets = tuple({x: os.path.join(config_dir, y) if x in STATE_FILE_SETTINGS else y for x, y in target.items()} for target in settings.targets)
+    return replace(settings,
+                   targets=targets,
+                   playlists_dir=settings.playlists_dir or settings.nvidia_shield_storage_path + settings.nvidia_shield_playlists_relative_root_path,
+                   **{x: os.path.join(config_dir, getattr(settings, x)) for x in STATE_FILE_SETTINGS})
         
 
 def main():
-    default_config = CustomPlexConfig("PlexServerDefaultConfig.json")
+    default_config = CustomPlexConfig(DEFAULT_CONFIG_FILE)
     print(default_config.data)
+    print(load_settings())
         
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,133 @@
+import os
+import gzip
+import pickle
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from SyncMetrics import SYNC_METRICS
+
+SNAPSHOT_VERSION = 1
+DEFAULT_MAX_WORKERS = 8
+
+"""
+Class that keeps a snapshot of every file of the music tree, so that the tracks of the playlists can be checked with a set lookup
+instead of a stat per track over the network share.
+The snapshot is stored as a gzipped pickle of the listing of every folder along with the folder mtime.
+A refresh only stats the folders, and only lists again the ones whose mtime changed, since adding, removing or renaming a file changes the mtime of its folder.
+"""
+class MusicStorageSnapshot:
+    def __init__(self, path, music_root_dir):
+        self.path = path
+        self.music_root_dir = music_root_dir
+        self.available = False # False until a refresh managed to read the music tree
+        self.missing_tracks = dict() # playlist path relative to the Latest folder, tracks that are not in the music tree
+        self.unmapped_tracks = dict() # playlist path relative to the Latest folder, tracks that are not under the music root as seen by plex
+        self._folders = self._parse(path) # relative folder, (mtime_ns, file names, subfolder names)
+        self._files = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, relative_path):
+        return relative_path in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+    def refresh(self, max_workers=DEFAULT_MAX_WORKERS):
+        """ Brings the snapshot up to date with the music tree, one level of folders at a time, with the folders of a level handled in parallel. """
+        if not os.path.isdir(self.music_root_dir):
+            logging.error("%s does not exist or is not a directory, the tracks of the playlists won't be checked!\n", self.music_root_dir)
+            return
+
+        folders = dict()
+        listed_count = 0
+        pending_folders = [""]
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="music_snapshot") as pool:
+            while pending_folders:
+                next_folders = []
+                for folder, (listing, listed) in zip(pending_folders, pool.map(self._refresh_folder, pending_folders)):
+                    if listing is None:
+                        continue
+                    folders[folder] = listing
+                    listed_count += listed
+                    next_folders.extend(folder + "/" + x if folder else x for x in listing[2])
+                pending_folders = next_folders
+
+        self._folders = folders
+        self._files = {folder + "/" + x if folder else x for folder, listing in folders.items() for x in listing[1]}
+        self.available = True
+        logging.info("The music snapshot has %d tracks, %d of its %d folders had to be listed\n", len(self._files), listed_count, len(folders))
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with gzip.open(temp_path, mode="wb", compresslevel=1) as snapshot_file:
+            pickle.dump({"version": SNAPSHOT_VERSION, "music_root_dir": self.music_root_dir, "folders": self._folders}, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.path)
+
+    def check_playlist(self, playlist_key, tracks, music_dir) -> tuple[list[str], list[str]]:
+        """ Returns the tracks of the playlist that are under <music_dir> (the music root as seen by plex) but not in the music tree,
+            and the ones that are not under <music_dir> at all, so they can't be checked. Both are remembered for the report.
+            Nothing is reported if the music tree could not be read.
+
+            Parameters:
+                playlist_key (str): Playlist path relative to the Latest folder.
+                tracks (list): Track paths of the converted playlist.
+                music_dir (str): Music root as seen by plex.
+        """
+        if not self.available:
+            return [], []
+
+        missing_tracks, unmapped_tracks = [], []
+        for track in tracks:
+            if not track.startswith(music_dir):
+                unmapped_tracks.append(track)
+            elif track[len(music_dir):] not in self._files:
+                missing_tracks.append(track)
+        if missing_tracks:
+            SYNC_METRICS.count("tracks_missing", len(missing_tracks))
+            with self._lock:
+                self.missing_tracks[playlist_key] = missing_tracks
+        if unmapped_tracks:
+            SYNC_METRICS.count("tracks_unmapped", len(unmapped_tracks))
+            with self._lock:
+                self.unmapped_tracks[playlist_key] = unmapped_tracks
+        return missing_tracks, unmapped_tracks
+
+    def _refresh_folder(self, folder):
+        """ Returns the (mtime_ns, file names, subfolder names) of the folder and whether it had to be listed, or None if it is gone. """
+        folder_path = os.path.join(self.music_root_dir, folder) if folder else self.music_root_dir
+        try:
+            mtime_ns = os.stat(folder_path).st_mtime_ns
+            listing = self._folders.get(folder)
+            if listing is not None and listing[0] == mtime_ns:
+                return listing, False
+
+            files, subfolders = [], []
+            with os.scandir(folder_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subfolders.append(entry.name)
+                    elif entry.is_file():
+                        files.append(entry.name)
+            return (mtime_ns, tuple(files), tuple(subfolders)), True
+        except OSError as exc:
+            logging.warning("Could not list %s: %s\n", folder_path, exc)
+            return None, False
+
+    def _parse(self, path):
+        if not os.path.isfile(path):
+            return {}
+
+        try:
+            with gzip.open(path, mode="rb") as snapshot_file:
+                data = pickle.load(snapshot_file)
+        except (OSError, EOFError, pickle.UnpicklingError) as exc:
+            logging.warning("Could not read the music snapshot %s, it will be rebuilt: %s\n", path, exc)
+            return {}
+
+        if data.get("version") != SNAPSHOT_VERSION or data.get("music_root_dir") != self.music_root_dir:
+            logging.info("The music snapshot %s is outdated, it will be rebuilt\n", path)
+            return {}
+
+        return data.get("folders", {})
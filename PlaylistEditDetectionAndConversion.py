@@ -2,22 +2,11 @@ import errno
 import os
 import glob
 import re
+import html
+import json
 import logging
-from CustomPlexConfig import CustomPlexConfig
-
-FREE_FILE_SYNC_LOGS_DIR = "D:/Music/MusicBee/Playlists/Logs"
-
-JSON_DATA_FILE = os.path.join(os.path.dirname(__file__), "PlexServerDefaultConfig.json")
-DEFAULT_PLEX_CONFIG = CustomPlexConfig(JSON_DATA_FILE)
-
-DEFAULT_NVIDIA_SHIELD_MACHINE_ID = DEFAULT_PLEX_CONFIG.get("nvidia_shield_id")
-DEFAULT_NVIDIA_SHIELD_STORAGE_ROOT = "/storage/%s/" % DEFAULT_NVIDIA_SHIELD_MACHINE_ID
-DEFAULT_NVIDIA_SHIELD_MUSIC_DIR = DEFAULT_NVIDIA_SHIELD_STORAGE_ROOT + DEFAULT_PLEX_CONFIG.get("nvidia_shield_music_relative_root_path")
-DEFAULT_NVIDIA_SHIELD_PLAYLIST_DIR = DEFAULT_NVIDIA_SHIELD_STORAGE_ROOT + DEFAULT_PLEX_CONFIG.get("nvidia_shield_playlists_relative_root_path")
-
-DEFAULT_PLAYLIST_DIR = DEFAULT_PLEX_CONFIG.get("nvidia_shield_storage_path") + DEFAULT_PLEX_CONFIG.get("nvidia_shield_playlists_relative_root_path") 
-DEFAULT_UNMODIFIED_PLAYLISTS_DIR = DEFAULT_PLAYLIST_DIR + "Latest/"
-DEFAULT_CONVERTED_PLAYLISTS_DIR = DEFAULT_PLAYLIST_DIR + "Converted/"
+from CustomPlexConfig import load_settings
+from SyncMetrics import SYNC_METRICS
 
 CREATED_PLAYLIST_KEYWORD = "Creating file"
 UPDATED_PLAYLIST_KEYWORD = "Updating file"
@@ -25,9 +14,10 @@ MOVED_PLAYLIST_KEYWORD = "Moving file"
 DELETED_PLAYLIST_KEYWORD = "Deleting file"
 
 EXPECTED_PLAYLIST_EXTENSION = "m3u"
+UNMODIFIED_PLAYLISTS_FOLDER_NAME = "Latest"
+REGEX_LOG_ACTION = re.compile(("(%s|%s|%s|%s) &quot;(.+?)&quot;(?: to &quot;(.+?)&quot;)?" % (CREATED_PLAYLIST_KEYWORD, UPDATED_PLAYLIST_KEYWORD, MOVED_PLAYLIST_KEYWORD, DELETED_PLAYLIST_KEYWORD)).encode("utf-8"))
+REGEX_LOG_PLAYLIST_NAME = re.compile("quot;(.+\\\\)*(.+)\.(.+?)\&quot")
 REGEX_PATTERN_EACH_IN_A_GROUP = "(\.\.\/\.\.\/)(.+)(\/)(.+)(\/)(.+)(\/)(.+)"
-#REGEX_PATTERN_REPLACE_WITH_INTERNAL_DRIVE_PATH = "(\.\.\/\.\.\/)"
-REGEX_PATTERN_REPLACE_WITH_INTERNAL_DRIVE_PATH = "(.+)Library"
 
 """
 Creates directories specified by a path.
@@ -41,22 +31,24 @@ def mkdir_p(path):
             pass
         else: raise
 
-def get_newest_log_file(log_dir = FREE_FILE_SYNC_LOGS_DIR) -> str:
+"""
+Returns the log files generated by freefilesync, oldest first.
+"""
+def get_log_files(log_dir) -> list[str]:
     if not os.path.exists(log_dir) or not os.path.isdir(log_dir):
         logging.error("%s does not exist or is not a directory!\n", log_dir)
-        return None
+        return []
     
-    directory = os.listdir(log_dir)
-    if len(directory) == 0:
+    list_of_files = glob.glob(os.path.join(log_dir, '*.html'))
+    if len(list_of_files) == 0:
         logging.error("%s does not contain any log files!\n", log_dir)
+    return sorted(list_of_files, key=os.path.getctime)
+
+def get_newest_log_file(log_dir) -> str:
+    list_of_files = get_log_files(log_dir)
+    if len(list_of_files) == 0:
         return None
-    
-    list_of_files = glob.glob(os.path.join(log_dir, '*.html'))
-    assert len(list_of_files) > 0, "No log files found in %s" % log_dir
-    newest_file = max(list_of_files, key=os.path.getctime)
-    assert newest_file is not None
-    
-    return newest_file
+    return list_of_files[-1]
 
 """
 Extracts playlist name from the log generated by freefilesync.
@@ -65,7 +57,7 @@ Not needed anymore.
 def extract_playlist_name_from_line(line) -> str:
     #result = re.search("Latest\\\\*(.+)\.m3u", line) #? if we use this, we need to use the first index in the group for the name
     #result = re.search("quot;(.+\\\\)*(.+)\.m3u", line) #? this does not account for files that are not m3u
-    result = re.search("quot;(.+\\\\)*(.+)\.(.+?)\&quot", line)
+    result = REGEX_LOG_PLAYLIST_NAME.search(line)
     if not result or result.lastindex < 2:
         logging.error("Failed to extract playlist name from line: %s\n", line)
         return None
@@ -77,73 +69,285 @@ def extract_playlist_name_from_line(line) -> str:
     return result.group(2)
 
 """
-Extracts playlists changes from the log generated by freefilesync.
-Not needed anymore.
+Returns the path relative to the latest playlists folder of a path logged by freefilesync,
+None if the path is not in the latest playlists folder and "" if it is not a playlist.
+"""
+def get_playlist_relative_path_from_log_path(path) -> str:
+    parts = re.split(r"[\\/]", path)
+    if UNMODIFIED_PLAYLISTS_FOLDER_NAME not in parts:
+        return None
+    
+    latest_folder_index = len(parts) - 1 - parts[::-1].index(UNMODIFIED_PLAYLISTS_FOLDER_NAME)
+    relative_path = "/".join(parts[latest_folder_index + 1:])
+    if not relative_path.endswith("." + EXPECTED_PLAYLIST_EXTENSION):
+        logging.warning("We have files that are not %s: %s\n", EXPECTED_PLAYLIST_EXTENSION, path)
+        return ""
+    return relative_path
+
 """
-def collect_playlists_from_log_file(log_file = get_newest_log_file()) -> tuple[list[str], list[str], list[str]]:
-    if not os.path.exists(log_file) or not os.path.isfile(log_file):
+Streams the file actions logged by freefilesync, starting at the specified byte offset.
+Yields (action keyword, path, destination path or None, offset right after the line) for every action,
+only complete lines are read so that a log that is still being written can be picked up later from the returned offset.
+"""
+def iter_log_file_actions(log_file, start_offset=0):
+    with open(log_file, mode="rb") as f:
+        f.seek(start_offset)
+        offset = start_offset
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            result = REGEX_LOG_ACTION.search(line)
+            if result is None:
+                continue
+            
+            action = result.group(1).decode("utf-8")
+            path = html.unescape(result.group(2).decode("utf-8", errors="replace"))
+            destination_path = html.unescape(result.group(3).decode("utf-8", errors="replace")) if result.group(3) else None
+            yield action, path, destination_path, offset
+
+"""
+Collects the playlists changes logged by freefilesync in a log file, from the specified byte offset.
+Returns the relative paths of the created/updated playlists, the relative paths of the removed ones, and the offset the next read should start from.
+Later actions win over earlier ones, so a playlist that was deleted and then created again ends up changed.
+"""
+def collect_playlist_changes_from_log_file(log_file, start_offset=0) -> tuple[set[str], set[str], int]:
+    changed_playlists = set()
+    removed_playlists = set()
+    end_offset = start_offset
+    for action, path, destination_path, end_offset in iter_log_file_actions(log_file, start_offset):
+        relative_path = get_playlist_relative_path_from_log_path(path)
+        if relative_path:
+            if action in (CREATED_PLAYLIST_KEYWORD, UPDATED_PLAYLIST_KEYWORD):
+                changed_playlists.add(relative_path)
+                removed_playlists.discard(relative_path)
+            else:
+                removed_playlists.add(relative_path)
+                changed_playlists.discard(relative_path)
+        
+        # a playlist moved within the latest playlists folder is a new playlist at its destination
+        if action == MOVED_PLAYLIST_KEYWORD and destination_path:
+            relative_path = get_playlist_relative_path_from_log_path(destination_path)
+            if relative_path:
+                changed_playlists.add(relative_path)
+                removed_playlists.discard(relative_path)
+    
+    return changed_playlists, removed_playlists, end_offset
+
+"""
+Extracts playlists changes from the log generated by freefilesync, by playlist name.
+"""
+def collect_playlists_from_log_file(log_file) -> tuple[set[str], set[str], set[str]]:
+    if log_file is None or not os.path.exists(log_file) or not os.path.isfile(log_file):
         logging.error("%s does not exist or is not a file!\n", log_file)
         return None, None, None
     
-    with open(log_file, mode="r", encoding="utf-8") as f:
-        lines = f.readlines()
-        created_playlists = set()
-        updated_playlists = set()
+    created_playlists = set()
+    updated_playlists = set()
+    removed_playlists = set()
+    for action, path, _, _ in iter_log_file_actions(log_file):
+        relative_path = get_playlist_relative_path_from_log_path(path)
+        if not relative_path:
+            continue
+        
+        playlist_name = os.path.splitext(os.path.basename(relative_path))[0]
+        if action == CREATED_PLAYLIST_KEYWORD:
+            playlists = created_playlists
+        elif action == UPDATED_PLAYLIST_KEYWORD:
+            playlists = updated_playlists
+        else:
+            playlists = removed_playlists
+        
+        if playlist_name in playlists:
+            logging.warning("%s has already been added to the %s playslists!\n", playlist_name, action.split(" ")[0].lower())
+        else:
+            playlists.add(playlist_name)
+    
+    return created_playlists, updated_playlists, removed_playlists
+
+"""
+Class that remembers which freefilesync log file, and up to which byte, we already turned into playlists changes.
+This way every run only reads the log entries written since the previous run, and the tool doesn't have to rescan the playlists tree.
+"""
+class FreeFileSyncLogState:
+    def __init__(self, path, log_dir):
+        self.path = path
+        self.log_dir = log_dir
+        self.data = self._parse(path)
+        self._pending_data = None
+
+    def collect_new_changes(self) -> tuple[set[str], set[str]]:
+        """ Returns the relative paths of the playlists that changed and the ones that were removed since the last saved state.
+            Returns None, None if we have no usable state yet, in which case the caller has to scan the playlists tree.
+            The new state is only remembered once save() is called, so a failed sync reads the same entries again.
+        """
+        log_files = get_log_files(self.log_dir)
+        if len(log_files) == 0:
+            return None, None
+        
+        last_log_file = self.data.get("log_file")
+        self._pending_data = {"log_file": log_files[-1], "offset": os.path.getsize(log_files[-1])}
+        if last_log_file not in log_files:
+            logging.info("No usable freefilesync log state in %s\n", self.path)
+            return None, None
+        
+        changed_playlists = set()
         removed_playlists = set()
-        for line in lines:
-            if line.find(CREATED_PLAYLIST_KEYWORD) > -1:
-                created_playlist = extract_playlist_name_from_line(line)
-                assert created_playlist is not None
-                if created_playlist in created_playlists:
-                    logging.warning("%s has already been added to the created playslists!\n", created_playlist)
-                elif created_playlist != "":
-                    created_playlists.add(created_playlist)
-                
-            elif line.find(UPDATED_PLAYLIST_KEYWORD) > -1:
-                updated_playlist = extract_playlist_name_from_line(line)
-                assert updated_playlist is not None
-                if updated_playlist in updated_playlists:
-                    logging.warning("%s has already been added to the updated playslists!\n", updated_playlist)
-                elif updated_playlist != "":
-                    updated_playlists.add(updated_playlist)
-                
-            elif line.find(MOVED_PLAYLIST_KEYWORD) > -1 or line.find(DELETED_PLAYLIST_KEYWORD) > -1:
-                removed_playlist = extract_playlist_name_from_line(line)
-                assert removed_playlist is not None
-                if removed_playlist in removed_playlists:
-                    logging.warning("%s has already been added to the removed playslists!\n", removed_playlist)
-                elif removed_playlist != "":
-                    removed_playlists.add(removed_playlist)
+        for log_file in log_files[log_files.index(last_log_file):]:
+            start_offset = self.data.get("offset", 0) if log_file == last_log_file else 0
+            changed, removed, end_offset = collect_playlist_changes_from_log_file(log_file, start_offset)
+            changed_playlists = (changed_playlists - removed) | changed
+            removed_playlists = (removed_playlists - changed) | removed
+            self._pending_data = {"log_file": log_file, "offset": end_offset}
         
-        return created_playlists, updated_playlists, removed_playlists
+        return changed_playlists, removed_playlists
+
+    def save(self):
+        if self._pending_data is None:
+            return
+        self.data = self._pending_data
+        with open(self.path, mode="w", encoding="utf-8") as json_file:
+            json.dump(self.data, json_file, indent=1)
+
+    def _parse(self, path):
+        if not os.path.isfile(path):
+            return {}
+        try:
+            with open(path, mode="r", encoding="utf-8") as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError) as exc:
+            logging.warning("Could not read the freefilesync log state %s: %s\n", path, exc)
+            return {}
+
+"""
+Returns a string that changes whenever the way we convert playlists changes.
+The sync manifest uses it to know if playlists that did not change locally still need to be converted and uploaded again.
+"""
+def get_conversion_signature(path_rewriter) -> str:
+    return path_rewriter.signature
+
+"""
+Logs the track paths of a playlist that no path rewrite rule matched, they are left as they are and plex won't find them.
+"""
+def log_unmatched_paths(playlist_file_path, unmatched_paths):
+    if unmatched_paths:
+        logging.warning("%d tracks of %s match no path rewrite rule and were left as they are: %s\n", len(unmatched_paths), playlist_file_path, unmatched_paths)
+        SYNC_METRICS.count("tracks_unmatched", len(unmatched_paths))
+
+"""
+Converts the lines of a playlist one by one, the file is never loaded as a whole.
+The line endings of the original playlist are kept as they are.
+The paths no rewrite rule matched are appended to <unmatched_paths>.
+"""
+def iter_converted_playlist_lines(playlist_file_path, path_rewriter, unmatched_paths=None):
+    with open(playlist_file_path, mode="r", encoding="utf-8", newline="") as playlist_file:
+        try:
+            for line in playlist_file:
+                yield path_rewriter.rewrite_line(line, unmatched_paths).encode("utf-8")
+        finally:
+            # what was pulled from the disk, read ahead included, the comparison with the target can stop early
+            SYNC_METRICS.count("bytes_read", playlist_file.buffer.tell())
+
+"""
+Returns the track paths of a playlist once converted, ignoring the comments/extended info lines, without writing the converted playlist anywhere.
+"""
+def read_converted_playlist_tracks(playlist_file_path, path_rewriter) -> list[str]:
+    if not os.path.exists(playlist_file_path) or not os.path.isfile(playlist_file_path):
+        logging.error("%s does not exist or is not a file!\n", playlist_file_path)
+        return None
+    
+    tracks = []
+    unmatched_paths = []
+    with open(playlist_file_path, mode="r", encoding="utf-8") as playlist_file:
+        for line in playlist_file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                track, matched = path_rewriter.try_rewrite_path(line)
+                tracks.append(track)
+                if not matched:
+                    unmatched_paths.append(line)
+        SYNC_METRICS.count("bytes_read", playlist_file.buffer.tell())
+    log_unmatched_paths(playlist_file_path, unmatched_paths)
+    return tracks
+
+"""
+Checks if the content of a file is exactly the given lines, reading it in step with them.
+"""
+def file_matches_lines(file_path, lines) -> bool:
+    try:
+        target_file = open(file_path, mode="rb")
+    except FileNotFoundError:
+        return False
+    
+    with target_file:
+        try:
+            for line in lines:
+                if target_file.read(len(line)) != line:
+                    return False
+            return target_file.read(1) == b""
+        finally:
+            SYNC_METRICS.count("bytes_read", target_file.tell())
 
 """
 Converts playlists that are created locally in windows to a fomat that works for plex on nvidia shield.
+The target is only written if the converted playlist differs from it, and it is written through a temp file that replaces it at once,
+so plex never reads a half written playlist.
+Returns True if the target was written, False if it was already up to date and None on failure.
 """
-def convert_playlist_for_plex(playlist_file_path, target_file_path):
+def convert_playlist_for_plex(playlist_file_path, target_file_path, path_rewriter):
     if not os.path.exists(playlist_file_path) or not os.path.isfile(playlist_file_path):
         logging.error("%s does not exist or is not a file!\n", playlist_file_path)
         return None
     
-    converted_lines = []
+    # the comparison stops at the first difference, the unmatched paths are only all there if the target is up to date
+    unmatched_paths = []
+    if file_matches_lines(target_file_path, iter_converted_playlist_lines(playlist_file_path, path_rewriter, unmatched_paths)):
+        log_unmatched_paths(playlist_file_path, unmatched_paths)
+        logging.debug("%s is already up to date\n", target_file_path)
+        SYNC_METRICS.count("conversions_unchanged")
+        return False
+    
     os.makedirs(os.path.dirname(target_file_path), exist_ok=True)
-    with open(target_file_path, mode="w", encoding="utf-8") as target_file:
-        with open(playlist_file_path, mode="r", encoding="utf-8") as playlist_file:
-            lines = playlist_file.readlines()
-            for line in lines:
-                converted_line = re.sub(REGEX_PATTERN_REPLACE_WITH_INTERNAL_DRIVE_PATH, DEFAULT_NVIDIA_SHIELD_MUSIC_DIR + "Library", line)
-                converted_lines.append(converted_line)         
-        target_file.writelines(converted_lines)
+    temp_file_path = target_file_path + ".tmp"
+    unmatched_paths = []
+    try:
+        with open(temp_file_path, mode="wb") as temp_file:
+            for converted_line in iter_converted_playlist_lines(playlist_file_path, path_rewriter, unmatched_paths):
+                temp_file.write(converted_line)
+            SYNC_METRICS.count("bytes_written", temp_file.tell())
+        os.replace(temp_file_path, target_file_path)
+    except BaseException:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise
         
+    log_unmatched_paths(playlist_file_path, unmatched_paths)
     logging.debug("Converted %s to %s\n", playlist_file_path, target_file_path)
+    SYNC_METRICS.count("conversions_written")
+    return True
+
+"""
+Same as convert_playlist_for_plex, but a conversion that raised is logged and returns None, so it can be used as a pool job.
+"""
+def try_convert_playlist_for_plex(playlist_file_path, target_file_path, path_rewriter):
+    try:
+        result = convert_playlist_for_plex(playlist_file_path, target_file_path, path_rewriter)
+    except Exception as exc:
+        logging.error("Failed to convert %s to %s: %s\n", playlist_file_path, target_file_path, exc)
+        result = None
+    if result is None:
+        SYNC_METRICS.count("conversions_failed")
+    return result
 
 """
 Testing ground
 """
 
 def main():
+    settings = load_settings()
+    
     print("--------- Newest log file test --------------")
-    newest_file = get_newest_log_file()
+    newest_file = get_newest_log_file(settings.free_file_sync_logs_dir)
     print(newest_file)
     
     print("\n--------- One line Playlist Extraction test --------------")
@@ -170,13 +374,13 @@ def main():
     
     print("\n--------- One line convertion test --------------")
     test_line = "../../Library/Eminem/Eyo/Rivers.mp3"
-    conversion_test = re.sub(REGEX_PATTERN_REPLACE_WITH_INTERNAL_DRIVE_PATH, DEFAULT_NVIDIA_SHIELD_MUSIC_DIR, test_line)
+    conversion_test = settings.path_rewriter.rewrite_path(test_line)
     print(test_line + "was converted to: " + conversion_test)
 
     print("\n--------- Playlist conversion test --------------")
-    orginal_playlist_path = DEFAULT_UNMODIFIED_PLAYLISTS_DIR + "Genres/Folk.m3u"
-    target_playlist_path = DEFAULT_CONVERTED_PLAYLISTS_DIR + "Genres/Folk.m3u"
-    convert_playlist_for_plex(orginal_playlist_path, target_playlist_path)
+    orginal_playlist_path = settings.unmodified_playlists_dir + "Genres/Folk.m3u"
+    target_playlist_path = settings.converted_playlists_dir + "Genres/Folk.m3u"
+    convert_playlist_for_plex(orginal_playlist_path, target_playlist_path, settings.path_rewriter)
     with open(target_playlist_path, mode="r", encoding="utf-8") as fin:
         print(fin.read())
     
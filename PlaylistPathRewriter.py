@@ -0,0 +1,91 @@
+import re
+import functools
+
+DEFAULT_CACHE_SIZE = 200000
+REGEX_PATH_SEPARATORS = re.compile(r"[\\/]")
+PARENT_SEGMENTS_WILDCARD = "**"
+
+"""
+Splits a path in its segments, windows and posix separators alike.
+"""
+def split_path(path) -> list[str]:
+    return REGEX_PATH_SEPARATORS.split(path)
+
+"""
+Class that rewrites the track paths of the playlists with a set of prefix rules, e.g. ../../Library/ -> /storage/<id>/Media/Music/Library/.
+The rules are compiled into a trie of path segments, so a path is matched against all of them in one walk, the longest matching prefix wins,
+and a prefix only ever matches whole segments (../../Library/ doesn't match ../../Library Band/).
+A ** segment in a prefix matches one or more .. segments, **/Library/ matches ../Library/ as well as ../../../Library/,
+so the rule still works when a playlist is moved to a deeper or shallower folder.
+Paths no rule matches are kept as they are, and reported as unmatched.
+Translated paths are memoized in a bounded cache, a track that shows up in many playlists is only translated once per run.
+"""
+class PlaylistPathRewriter:
+    def __init__(self, rules, cache_size=DEFAULT_CACHE_SIZE):
+        self.rules = [(x, y) for x, y in rules] # source prefix, target prefix
+        self._trie = dict() # segment, child node. The target of a rule ending at a node is stored under the None key
+        for source_prefix, target_prefix in self.rules:
+            node = self._trie
+            for segment in split_path(source_prefix.rstrip("\\/")):
+                if segment == PARENT_SEGMENTS_WILDCARD:
+                    parent_node = node.setdefault(PARENT_SEGMENTS_WILDCARD, dict())
+                    # loops on itself, so it takes in every following .. segment
+                    node = parent_node.setdefault("..", parent_node)
+                else:
+                    node = node.setdefault(segment, dict())
+            node[None] = target_prefix
+        # lru_cache is thread safe, the conversion workers share the cache
+        self.try_rewrite_path = functools.lru_cache(maxsize=cache_size)(self._try_rewrite_path)
+
+    @property
+    def signature(self) -> str:
+        """ Changes whenever the rules change, see PlaylistSyncManifest. """
+        return "; ".join("%s -> %s" % x for x in self.rules)
+
+    def rewrite_path(self, path) -> str:
+        return self.try_rewrite_path(path)[0]
+
+    def rewrite_line(self, line, unmatched_paths=None) -> str:
+        """ Rewrites the path of a playlist line, comments, blank lines and line endings are kept as they are.
+            The path is appended to <unmatched_paths> if no rule matched it.
+        """
+        path = line.rstrip("\r\n")
+        if not path or path.startswith("#"):
+            return line
+        rewritten_path, matched = self.try_rewrite_path(path)
+        if not matched and unmatched_paths is not None:
+            unmatched_paths.append(path)
+        return rewritten_path + line[len(path):]
+
+    def cache_info(self):
+        return self.try_rewrite_path.cache_info()
+
+    def _try_rewrite_path(self, path) -> tuple[str, bool]:
+        """ Returns the rewritten path, and whether a rule matched it. """
+        segments = split_path(path)
+        # a path can go down both a ** node and a plain .. node, all the nodes it reached are walked together
+        nodes = [self._trie]
+        target_prefix, matched_count = None, 0
+        for i, segment in enumerate(segments):
+            next_nodes = []
+            for node in nodes:
+                for child in (node.get(segment), node.get(PARENT_SEGMENTS_WILDCARD) if segment == ".." else None):
+                    if child is not None and all(x is not child for x in next_nodes):
+                        next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                break
+            for node in nodes:
+                if None in node:
+                    target_prefix, matched_count = node[None], i + 1
+                    break
+
+        if target_prefix is None:
+            return path, False
+
+        remaining_path = "/".join(segments[matched_count:])
+        if not remaining_path:
+            return target_prefix, True
+        if target_prefix and not target_prefix.endswith("/"):
+            target_prefix += "/"
+        return target_prefix + remaining_path, True
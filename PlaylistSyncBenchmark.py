@@ -0,0 +1,557 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import importlib.util
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import quoteattr
+
+from CustomPlexConfig import load_settings
+from PlaylistSyncManifest import PlaylistSyncManifest
+from PlexPlaylistIndex import PlexPlaylistIndex
+from PlexPlaylistUpdater import create_playlist_from_rating_keys, update_playlist_in_place
+from PlexTrackIndex import PlexTrackIndex
+from PlaylistTreeIndexer import index_playlist_tree
+from SharedSyncWork import SharedSyncWork
+import PlexPersonalPlaylistAPI
+
+DEFAULT_PLAYLIST_COUNT = 2000
+DEFAULT_TRACKS_PER_PLAYLIST = 25
+DEFAULT_LIBRARY_TRACK_COUNT = 20000
+DEFAULT_FOLDER_COUNT = 20
+DEFAULT_LATENCY_MS = 5
+DEFAULT_TOUCHED_PLAYLISTS_RATIO = 0.05
+
+BENCHMARK_SHIELD_ID = "BENCHMARK"
+BENCHMARK_MUSIC_SECTION_ID = "1"
+BENCHMARK_MUSIC_SECTION_NAME = "Music"
+BENCHMARK_MACHINE_ID = "benchmark"
+BENCHMARK_TRACKS_ADDED_AT = 1700000000 # each track of the synthetic library is added a second after the previous one
+
+"""
+A plex playlist as far as the diff is concerned.
+"""
+FakePlaylist = namedtuple("FakePlaylist", ["title", "ratingKey", "smart"])
+
+"""
+Wall time of a benchmark phase, with the number of items it went through.
+"""
+PhaseResult = namedtuple("PhaseResult", ["name", "seconds", "items", "unit"])
+
+
+"""
+Returns the path a synthetic track has in the playlists, relative to the latest playlists folder like the ones MusicBee writes.
+"""
+def get_synthetic_track_path(track_index) -> str:
+    return "../../Library/Artist %03d/Album %02d/%02d Track %d.mp3" % (track_index // 200, track_index // 20 % 10, track_index % 20 + 1, track_index)
+
+"""
+Generates a playlists tree shaped like the one MusicBee and FreeFileSync give us:
+<root_dir>/Playlists/Latest/<folder>/<playlist>.m3u, with every playlist pointing at tracks of a synthetic library of <library_track_count> tracks.
+Returns the number of track entries written.
+"""
+def generate_synthetic_playlists(root_dir, playlist_count, tracks_per_playlist, library_track_count, folder_count, seed=0) -> int:
+    rng = random.Random(seed)
+    unmodified_playlists_dir = os.path.join(root_dir, "Playlists", "Latest")
+    track_count = 0
+    for playlist_index in range(playlist_count):
+        folder = "Folder %02d" % (playlist_index % folder_count) if folder_count else ""
+        folder_path = os.path.join(unmodified_playlists_dir, folder)
+        os.makedirs(folder_path, exist_ok=True)
+        tracks = rng.sample(range(library_track_count), min(tracks_per_playlist, library_track_count))
+        with open(os.path.join(folder_path, "Playlist %05d.m3u" % playlist_index), mode="w", encoding="utf-8", newline="\r\n") as playlist_file:
+            playlist_file.write("#EXTM3U\n")
+            for track_index in tracks:
+                playlist_file.write(get_synthetic_track_path(track_index) + "\n")
+        track_count += len(tracks)
+    return track_count
+
+"""
+Writes a config that points the sync at the synthetic tree and at the fake plex server, and returns its path.
+The manifest and the freefilesync log state land next to it, so the benchmark never touches the real ones.
+"""
+def write_benchmark_config(root_dir, plex_url, conversion_max_workers, plex_api_max_workers) -> str:
+    config = {
+        "plex_url": plex_url,
+        "plex_token": "benchmark",
+        "music_lib_section_name": BENCHMARK_MUSIC_SECTION_NAME,
+        "incremental_update": True,
+        "plex_api_max_workers": plex_api_max_workers,
+        "plex_api_max_retries": 1,
+        "plex_api_retry_backoff_seconds": 0.1,
+        "conversion_max_workers": conversion_max_workers,
+        "free_file_sync_logs_dir": os.path.join(root_dir, "Logs").replace("\\", "/"),
+        "nvidia_shield_storage_path": root_dir.replace("\\", "/") + "/",
+        "nvidia_shield_music_relative_root_path": "Music/",
+        "nvidia_shield_playlists_relative_root_path": "Playlists/",
+        "nvidia_shield_id": BENCHMARK_SHIELD_ID,
+    }
+    config_path = os.path.join(root_dir, "PlexServerBenchmarkConfig.json")
+    with open(config_path, mode="w", encoding="utf-8") as json_file:
+        json.dump(config, json_file, indent=1)
+    return config_path
+
+
+"""
+Class that stands in for the plex endpoints the sync uses: the server and sections listings, the music section tracks with their filters
+(what the incremental refresh of the track index asks for), the tracks by ratingKey, and the playlists listing, upload, edit, delete and items endpoints.
+Every request waits <latency_seconds> before being answered, and the time spent on each kind of request is recorded.
+Uploaded playlists are read from the local converted playlists folder, their tracks are matched against the synthetic library.
+"""
+class FakePlexServer:
+    def __init__(self, library_track_count, nvidia_shield_music_dir, plex_internal_converted_playlists_dir, converted_playlists_dir, latency_seconds=0.0):
+        self.latency_seconds = latency_seconds
+        self.plex_internal_converted_playlists_dir = plex_internal_converted_playlists_dir
+        self.converted_playlists_dir = converted_playlists_dir
+        self.tracks = [nvidia_shield_music_dir + get_synthetic_track_path(x)[len("../../"):] for x in range(library_track_count)] # ratingKey - 1, file
+        self.track_ids = {x: y + 1 for y, x in enumerate(self.tracks)}
+        self.playlists = dict() # ratingKey, {title, guid, items: [(playlistItemID, track ratingKey)]}
+        self.latencies = dict() # endpoint, list of seconds
+        self._next_id = library_track_count + 1
+        self._lock = threading.Lock()
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return "http://%s:%d" % self._httpd.server_address[:2]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        server = self
+        class Handler(_FakePlexRequestHandler):
+            fake_server = server
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake_plex", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def reset_latencies(self) -> dict:
+        with self._lock:
+            latencies = self.latencies
+            self.latencies = dict()
+        return latencies
+
+    def record_latency(self, endpoint, seconds):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+
+    def new_id(self) -> int:
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    def upload_playlist(self, path):
+        local_path = path
+        if path.startswith(self.plex_internal_converted_playlists_dir):
+            local_path = os.path.join(self.converted_playlists_dir, path[len(self.plex_internal_converted_playlists_dir):])
+        track_ids = []
+        with open(local_path, mode="r", encoding="utf-8") as playlist_file:
+            for line in playlist_file:
+                track_id = self.track_ids.get(line.strip())
+                if track_id is not None:
+                    track_ids.append(track_id)
+        self.create_playlist(os.path.splitext(os.path.basename(path))[0], track_ids, "com.plexapp.agents.none://" + path)
+
+    def create_playlist(self, title, track_ids, guid=None) -> int:
+        items = [(self.new_id(), x) for x in track_ids]
+        rating_key = self.new_id()
+        with self._lock:
+            self.playlists[rating_key] = {"title": title, "guid": guid or "com.plexapp.agents.none://%d" % rating_key, "items": items}
+        return rating_key
+
+    def playlist_xml(self, rating_key) -> str:
+        playlist = self.playlists[rating_key]
+        return "<Playlist type=\"playlist\" ratingKey=\"%d\" key=\"/playlists/%d/items\" guid=%s title=%s smart=\"0\" playlistType=\"audio\" leafCount=\"%d\" />" % (
+            rating_key, rating_key, quoteattr(playlist["guid"]), quoteattr(playlist["title"]), len(playlist["items"]))
+
+    def track_xml(self, track_id, playlist_item_id=None) -> str:
+        file = self.tracks[track_id - 1]
+        playlist_item = " playlistItemID=\"%d\"" % playlist_item_id if playlist_item_id is not None else ""
+        added_at = BENCHMARK_TRACKS_ADDED_AT + track_id
+        return ("<Track type=\"track\" ratingKey=\"%d\" key=\"/library/metadata/%d\" title=%s librarySectionID=\"%s\" addedAt=\"%d\" updatedAt=\"%d\"%s>"
+                "<Media id=\"%d\"><Part id=\"%d\" file=%s /></Media></Track>") % (
+            track_id, track_id, quoteattr(os.path.basename(file)), BENCHMARK_MUSIC_SECTION_ID, added_at, added_at, playlist_item, track_id, track_id, quoteattr(file))
+
+
+"""
+Routes the plex api requests to the fake server.
+"""
+class _FakePlexRequestHandler(BaseHTTPRequestHandler):
+    fake_server = None
+    protocol_version = "HTTP/1.1"
+
+    # the filter fields and operators plexapi checks a search against
+    TRACK_FILTERS_META = ("<Meta><Type key=\"/library/sections/%s/all?type=10\" type=\"track\" title=\"Tracks\" active=\"0\">"
+                          "<Field key=\"track.addedAt\" title=\"Date Added\" type=\"date\" /><Field key=\"track.updatedAt\" title=\"Date Updated\" type=\"date\" />"
+                          "</Type><FieldType type=\"date\"><Operator key=\"&gt;&gt;=\" title=\"is after\" /></FieldType></Meta>") % BENCHMARK_MUSIC_SECTION_ID
+
+    ROUTES = [
+        ("GET", re.compile(r"^/$"), "server", "_get_server"),
+        ("GET", re.compile(r"^/library$"), "library", "_get_library"),
+        ("GET", re.compile(r"^/library/sections/?$"), "sections", "_get_sections"),
+        ("GET", re.compile(r"^/library/sections/(\d+)/all$"), "section tracks", "_get_section_tracks"),
+        ("GET", re.compile(r"^/library/sections/(\d+)/collections$"), "section collections", "_get_section_collections"),
+        ("GET", re.compile(r"^/library/metadata/[\d,]+$"), "get tracks", "_get_tracks"),
+        ("GET", re.compile(r"^/playlists$"), "list playlists", "_get_playlists"),
+        ("POST", re.compile(r"^/playlists$"), "create playlist", "_create_playlist"),
+        ("POST", re.compile(r"^/playlists/upload$"), "upload playlist", "_upload_playlist"),
+        ("GET", re.compile(r"^/playlists/(\d+)$"), "get playlist", "_get_playlist"),
+        ("PUT", re.compile(r"^/playlists/(\d+)$"), "edit playlist", "_edit_playlist"),
+        ("DELETE", re.compile(r"^/playlists/(\d+)$"), "delete playlist", "_delete_playlist"),
+        ("GET", re.compile(r"^/playlists/(\d+)/items$"), "get playlist items", "_get_playlist_items"),
+        ("PUT", re.compile(r"^/playlists/(\d+)/items$"), "add playlist items", "_add_playlist_items"),
+        ("DELETE", re.compile(r"^/playlists/(\d+)/items/(\d+)$"), "remove playlist item", "_remove_playlist_item"),
+        ("PUT", re.compile(r"^/playlists/(\d+)/items/(\d+)/move$"), "move playlist item", "_move_playlist_item"),
+    ]
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_PUT(self):
+        self._route("PUT")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+    def log_message(self, format, *args):
+        pass
+
+    def _route(self, method):
+        start_time = time.perf_counter()
+        url = urlsplit(self.path)
+        self.query = {x: y[-1] for x, y in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+
+        for route_method, route_regex, endpoint, handler_name in self.ROUTES:
+            result = route_regex.match(url.path) if route_method == method else None
+            if result is None:
+                continue
+            if self.fake_server.latency_seconds:
+                time.sleep(self.fake_server.latency_seconds)
+            try:
+                status, body = getattr(self, handler_name)(*(int(x) for x in result.groups()))
+            except KeyError:
+                status, body = 404, ""
+            self._respond(status, body)
+            self.fake_server.record_latency(endpoint, time.perf_counter() - start_time)
+            return
+
+        self._respond(404, "")
+        self.fake_server.record_latency("unknown %s %s" % (method, url.path), time.perf_counter() - start_time)
+
+    def _respond(self, status, body):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml;charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _container(self, elements, **attributes):
+        """ Wraps the elements in a MediaContainer, honouring the paging plexapi asks for. """
+        total_size = len(elements)
+        start = int(self.headers.get("X-Plex-Container-Start") or self.query.get("X-Plex-Container-Start") or 0)
+        size = self.headers.get("X-Plex-Container-Size") or self.query.get("X-Plex-Container-Size")
+        elements = elements[start:start + int(size)] if size is not None else elements[start:]
+        meta = attributes.pop("meta", "")
+        attributes = "".join(" %s=%s" % (x, quoteattr(str(y))) for x, y in attributes.items())
+        return 200, "<MediaContainer size=\"%d\" totalSize=\"%d\" offset=\"%d\"%s>%s%s</MediaContainer>" % (len(elements), total_size, start, attributes, meta, "".join(elements))
+
+    def _get_server(self):
+        return self._container([], friendlyName="Fake Plex", machineIdentifier=BENCHMARK_MACHINE_ID, version="1.40.0.0", platform="Linux")
+
+    def _get_library(self):
+        return self._container([], title1="Plex Library", identifier="com.plexapp.plugins.library")
+
+    def _get_sections(self):
+        return self._container(["<Directory key=\"%s\" type=\"artist\" title=\"%s\" agent=\"tv.plex.agents.music\" scanner=\"Plex Music\" language=\"en\" uuid=\"benchmark\">"
+                                "<Location id=\"1\" path=\"/storage/%s/Music\" /></Directory>" % (BENCHMARK_MUSIC_SECTION_ID, BENCHMARK_MUSIC_SECTION_NAME, BENCHMARK_SHIELD_ID)])
+
+    def _get_section_tracks(self, section_id):
+        if self.query.get("includeMeta") == "1":
+            return self._container([], librarySectionID=section_id, meta=self.TRACK_FILTERS_META)
+        track_ids = range(1, len(self.fake_server.tracks) + 1)
+        # the tracks added or updated after a date, the only filters the track index uses
+        since = [int(y) for x, y in self.query.items() if x in ("track.addedAt>>", "track.updatedAt>>")]
+        if since:
+            track_ids = [x for x in track_ids if BENCHMARK_TRACKS_ADDED_AT + x > min(since)]
+        return self._container([self.fake_server.track_xml(x) for x in track_ids], librarySectionID=section_id)
+
+    def _get_section_collections(self, section_id):
+        return self._container([], librarySectionID=section_id, meta="<Meta />")
+
+    def _get_tracks(self):
+        track_ids = [int(x) for x in urlsplit(self.path).path.rpartition("/")[2].split(",")]
+        return self._container([self.fake_server.track_xml(x) for x in track_ids if 0 < x <= len(self.fake_server.tracks)])
+
+    def _get_playlists(self):
+        with self.fake_server._lock:
+            rating_keys = list(self.fake_server.playlists)
+        return self._container([self.fake_server.playlist_xml(x) for x in rating_keys])
+
+    def _create_playlist(self):
+        rating_key = self.fake_server.create_playlist(self.query["title"], self._get_uri_track_ids())
+        return self._container([self.fake_server.playlist_xml(rating_key)])
+
+    def _upload_playlist(self):
+        self.fake_server.upload_playlist(self.query["path"])
+        return 200, ""
+
+    def _get_playlist(self, rating_key):
+        return self._container([self.fake_server.playlist_xml(rating_key)])
+
+    def _edit_playlist(self, rating_key):
+        if "title" in self.query:
+            self.fake_server.playlists[rating_key]["title"] = self.query["title"]
+        return self._container([self.fake_server.playlist_xml(rating_key)])
+
+    def _delete_playlist(self, rating_key):
+        with self.fake_server._lock:
+            del self.fake_server.playlists[rating_key]
+        return 200, ""
+
+    def _get_playlist_items(self, rating_key):
+        items = list(self.fake_server.playlists[rating_key]["items"])
+        return self._container([self.fake_server.track_xml(y, x) for x, y in items])
+
+    def _add_playlist_items(self, rating_key):
+        items = self.fake_server.playlists[rating_key]["items"]
+        items.extend((self.fake_server.new_id(), x) for x in self._get_uri_track_ids())
+        return self._container([self.fake_server.playlist_xml(rating_key)])
+
+    def _get_uri_track_ids(self):
+        return [int(x) for x in self.query.get("uri", "").rpartition("/library/metadata/")[2].split(",") if x]
+
+    def _remove_playlist_item(self, rating_key, playlist_item_id):
+        items = self.fake_server.playlists[rating_key]["items"]
+        items[:] = [x for x in items if x[0] != playlist_item_id]
+        return self._container([self.fake_server.playlist_xml(rating_key)])
+
+    def _move_playlist_item(self, rating_key, playlist_item_id):
+        items = self.fake_server.playlists[rating_key]["items"]
+        item = next(x for x in items if x[0] == playlist_item_id)
+        items.remove(item)
+        after = int(self.query.get("after", 0))
+        position = next((x + 1 for x, y in enumerate(items) if y[0] == after), 0)
+        items.insert(position, item)
+        return self._container([self.fake_server.playlist_xml(rating_key)])
+
+
+"""
+Returns the <percent> percentile of sorted values.
+"""
+def get_percentile(sorted_values, percent) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+"""
+Appends a track to a share of the playlists, the way editing them in MusicBee would, and returns how many were touched.
+"""
+def touch_playlists(unmodified_playlists_dir, playlists, ratio, library_track_count, seed=0) -> int:
+    rng = random.Random(seed)
+    touched_playlists = rng.sample(sorted(playlists), int(len(playlists) * ratio))
+    for playlist_key in touched_playlists:
+        with open(os.path.join(unmodified_playlists_dir, playlist_key), mode="a", encoding="utf-8", newline="\r\n") as playlist_file:
+            playlist_file.write(get_synthetic_track_path(rng.randrange(library_track_count)) + "\n")
+    return len(touched_playlists)
+
+"""
+Runs fn(*args), which returns the number of items it went through, and records how long it took.
+"""
+def run_phase(results, name, unit, fn, *args):
+    start_time = time.perf_counter()
+    items = fn(*args)
+    results.append(PhaseResult(name, time.perf_counter() - start_time, items, unit))
+    return items
+
+
+"""
+Benchmarks the local part of the sync: scanning and diffing the playlists tree, and converting it.
+"""
+def benchmark_local_phases(results, settings, library_track_count, touched_playlists_ratio):
+    unmodified_playlists_dir = settings.unmodified_playlists_dir
+    playlists = index_playlist_tree(unmodified_playlists_dir)
+    run_phase(results, "scan playlists tree", "playlists", lambda: len(index_playlist_tree(unmodified_playlists_dir)))
+
+    manifest = PlaylistSyncManifest(os.path.join(settings.playlists_dir, "BenchmarkManifest.json"))
+    def diff(playlist_index):
+        operations = [x[0] for x in PlexPersonalPlaylistAPI.iter_playlist_operations(playlist_index, unmodified_playlists_dir, manifest, False)]
+        logging.info("Diff: %d playlists to create, %d to update\n", operations.count(PlexPersonalPlaylistAPI.CREATE_PLAYLIST), operations.count(PlexPersonalPlaylistAPI.UPDATE_PLAYLIST))
+        return len(playlists)
+    run_phase(results, "diff (empty plex)", "playlists", diff, PlexPlaylistIndex())
+
+    playlist_index = PlexPlaylistIndex(FakePlaylist(y.name, x, False) for x, y in enumerate(playlists.values()))
+    def record():
+        for rating_key, (playlist_key, playlist_record) in enumerate(playlists.items()):
+            playlist_version = manifest.get_version(playlist_key, os.path.join(unmodified_playlists_dir, playlist_key), playlist_record.size, playlist_record.mtime)
+            manifest.record(playlist_key, playlist_version, rating_key)
+        return len(playlists)
+    run_phase(results, "hash and record manifest", "playlists", record)
+    run_phase(results, "diff (everything synced)", "playlists", diff, playlist_index)
+
+    touched_playlists = touch_playlists(unmodified_playlists_dir, playlists, touched_playlists_ratio, library_track_count)
+    logging.info("Touched %d playlists\n", touched_playlists)
+    run_phase(results, "diff (%d touched)" % touched_playlists, "playlists", diff, playlist_index)
+
+    playlists = index_playlist_tree(unmodified_playlists_dir)
+    def convert():
+        # the way the sync converts, see convert_and_submit_playlist
+        shared_work = SharedSyncWork()
+        with ThreadPoolExecutor(max_workers=settings.conversion_max_workers, thread_name_prefix="conversion") as pool:
+            futures = [pool.submit(shared_work.convert_playlist, os.path.join(unmodified_playlists_dir, x), os.path.join(settings.converted_playlists_dir, x),
+                                   settings.path_rewriter, y.size, y.mtime) for x, y in playlists.items()]
+        return sum(1 for x in futures if x.result() is not None)
+    run_phase(results, "convert (cold)", "playlists", convert)
+    run_phase(results, "convert (unchanged)", "playlists", convert)
+    shutil.rmtree(settings.converted_playlists_dir)
+
+"""
+Benchmarks whole runs of the sync script against the fake plex server, each one in its own process so its startup is part of the measure.
+"""
+def benchmark_sync(results, latencies, settings, config_path, fake_server, playlists_count, library_track_count, touched_playlists_ratio):
+    metrics_path = os.path.join(os.path.dirname(config_path), "SyncMetrics.json")
+    def sync(name):
+        start_time = time.perf_counter()
+        process = subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "PlexPersonalPlaylistAPI.py"), "--config", config_path,
+                                  "--metrics_out", metrics_path], cwd=os.path.dirname(config_path), capture_output=True, text=True)
+        seconds = time.perf_counter() - start_time
+        if process.returncode != 0:
+            logging.error("%s failed with exit code %d:\n%s\n", name, process.returncode, process.stderr[-4000:])
+        results.append(PhaseResult(name, seconds, playlists_count, "playlists"))
+        latencies[name] = fake_server.reset_latencies()
+        if os.path.isfile(metrics_path):
+            # the breakdown the sync measured itself
+            with open(metrics_path, mode="r", encoding="utf-8") as json_file:
+                metrics = json.load(json_file)
+            for phase, phase_seconds in metrics["phases"].items():
+                results.append(PhaseResult("  " + phase, phase_seconds, 0, ""))
+            os.remove(metrics_path)
+
+    sync("sync (initial)")
+    sync("sync (unchanged)")
+    touched_playlists = touch_playlists(settings.unmodified_playlists_dir, index_playlist_tree(settings.unmodified_playlists_dir), touched_playlists_ratio, library_track_count,
+                                        seed=1)
+    sync("sync (%d touched)" % touched_playlists)
+
+"""
+Updates the same plex playlist object twice in a row against the fake plex server, like watch mode and the retries of the plex workers do,
+and checks that the playlist ends up with the tracks of the second update, in order.
+"""
+def check_repeated_update_in_place(settings, fake_server) -> bool:
+    from plexapi.server import PlexServer
+
+    plex = PlexServer(fake_server.url, "benchmark")
+    track_index = PlexTrackIndex(settings.track_index_file)
+    track_index.refresh(plex, plex.library.section(BENCHMARK_MUSIC_SECTION_NAME))
+    paths = fake_server.tracks[:5]
+    playlist_obj = create_playlist_from_rating_keys(plex, "Repeated update", [fake_server.track_ids[x] for x in paths])
+    try:
+        for order in ([4, 3, 2, 1, 0], [3, 2, 1, 0, 4]):
+            update_playlist_in_place(plex, playlist_obj, [paths[x] for x in order], track_index)
+        track_ids = [x[1] for x in fake_server.playlists[playlist_obj.ratingKey]["items"]]
+    finally:
+        playlist_obj.delete()
+    if track_ids != [fake_server.track_ids[paths[x]] for x in order]:
+        logging.error("The second update in place of the same playlist was not applied, plex has tracks %s\n", track_ids)
+        return False
+    return True
+
+"""
+Prints the wall time and throughput of every phase, and the latency of the plex requests made by every sync.
+"""
+def print_report(results, latencies):
+    print("\n%-32s %10s %12s %16s" % ("phase", "seconds", "items", "throughput"))
+    for result in results:
+        if not result.unit:
+            print("%-32s %10.3f" % (result.name, result.seconds))
+            continue
+        throughput = "%.0f %s/s" % (result.items / result.seconds, result.unit) if result.seconds > 0 else "-"
+        print("%-32s %10.3f %12d %16s" % (result.name, result.seconds, result.items, throughput))
+
+    for name, endpoints in latencies.items():
+        print("\n%s, plex requests:" % name)
+        print("  %-28s %8s %10s %10s %10s" % ("endpoint", "count", "p50 ms", "p95 ms", "max ms"))
+        for endpoint, values in sorted(endpoints.items()):
+            values = sorted(values)
+            print("  %-28s %8d %10.1f %10.1f %10.1f" % (endpoint, len(values), get_percentile(values, 50) * 1000, get_percentile(values, 95) * 1000, values[-1] * 1000))
+
+def parse_args():
+
+    parser = argparse.ArgumentParser(description="Benchmark the playlists sync against a synthetic playlists tree and a fake plex server")
+
+    parser.add_argument("-p", "--playlists", type=int, default=DEFAULT_PLAYLIST_COUNT, help="The number of playlists to generate")
+    parser.add_argument("-t", "--tracks_per_playlist", type=int, default=DEFAULT_TRACKS_PER_PLAYLIST, help="The number of tracks in each playlist")
+    parser.add_argument("--library_tracks", type=int, default=DEFAULT_LIBRARY_TRACK_COUNT, help="The number of tracks in the synthetic library")
+    parser.add_argument("--folders", type=int, default=DEFAULT_FOLDER_COUNT, help="The number of folders the playlists are spread over")
+    parser.add_argument("--latency_ms", type=float, default=DEFAULT_LATENCY_MS, help="The time the fake plex server waits before answering each request")
+    parser.add_argument("--touched_ratio", type=float, default=DEFAULT_TOUCHED_PLAYLISTS_RATIO, help="The share of playlists modified before the incremental runs")
+    parser.add_argument("-w", "--max_workers", type=int, default=4, help="The number of Plex requests allowed to run at the same time")
+    parser.add_argument("-c", "--conversion_workers", type=int, default=4, help="The number of playlists allowed to be converted at the same time")
+    parser.add_argument("--work_dir", type=str, help="Where to generate the synthetic tree, a temporary folder that is removed afterwards by default")
+    parser.add_argument("--skip_sync", action=argparse.BooleanOptionalAction, help="If added, only the local phases are benchmarked")
+
+    return parser.parse_args()
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = parse_args()
+
+    root_dir = args.work_dir or tempfile.mkdtemp(prefix="PlaylistSyncBenchmark")
+    os.makedirs(root_dir, exist_ok=True)
+    results = []
+    latencies = dict()
+    try:
+        track_count = run_phase(results, "generate playlists", "tracks", generate_synthetic_playlists, root_dir, args.playlists, args.tracks_per_playlist, args.library_tracks, args.folders)
+        logging.info("Generated %d playlists with %d tracks in %s\n", args.playlists, track_count, root_dir)
+
+        with FakePlexServer(args.library_tracks, "/storage/%s/Music/" % BENCHMARK_SHIELD_ID, "/storage/%s/Playlists/Converted/" % BENCHMARK_SHIELD_ID,
+                            os.path.join(root_dir, "Playlists", "Converted"), args.latency_ms / 1000) as fake_server:
+            config_path = write_benchmark_config(root_dir, fake_server.url, args.conversion_workers, args.max_workers)
+            settings = load_settings(config_path)
+            benchmark_local_phases(results, settings, args.library_tracks, args.touched_ratio)
+
+            if args.skip_sync:
+                pass
+            elif importlib.util.find_spec("plexapi") is None:
+                logging.warning("plexapi is not installed, skipping the sync benchmarks\n")
+            else:
+                benchmark_sync(results, latencies, settings, config_path, fake_server, args.playlists, args.library_tracks, args.touched_ratio)
+                if check_repeated_update_in_place(settings, fake_server):
+                    logging.info("Updating the same playlist twice in place applied both updates\n")
+                fake_server.reset_latencies()
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(root_dir, ignore_errors=True)
+
+    print_report(results, latencies)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import os
+import json
+import logging
+import threading
+
+from SyncMetrics import SYNC_METRICS
+
+JOURNAL_VERSION = 1
+
+"""
+The operations the journal keeps track of, per playlist.
+"""
+CONVERT_OPERATION = "convert"
+DELETE_OPERATION = "delete"
+CREATE_OPERATION = "create"
+UPDATE_OPERATION = "update"
+
+"""
+Class that keeps a write-ahead journal of a sync, so that a sync that was interrupted (network drop, plex restart, ctrl-c) can be resumed.
+Every operation is written as planned before it starts and as completed once it is done, one json line each, flushed to disk right away.
+Creates and updates are only completed once they are on plex, and their line carries the manifest entry of the playlist,
+so recovering puts back in the manifest whatever the interrupted sync uploaded, even if it never got to save the manifest.
+The next sync then only has to redo the operations that were still pending, the journal is removed once a sync goes through.
+"""
+class PlaylistSyncJournal:
+    def __init__(self, path, conversion_signature=""):
+        self.path = path
+        self.conversion_signature = conversion_signature
+        self._completed = dict() # (operation, playlist), details of the operations the interrupted sync completed
+        self._file = None
+        self._lock = threading.Lock()
+
+    def recover(self, manifest):
+        """ Reads what an interrupted sync left behind, and puts back in the manifest the playlists it uploaded.
+            Returns the number of operations it completed.
+        """
+        planned, completed = self._parse(self.path)
+        for (operation, playlist), details in completed.items():
+            if operation in (CREATE_OPERATION, UPDATE_OPERATION) and details.get("entry") is not None:
+                manifest.restore(playlist, details["entry"])
+        self._completed = completed
+
+        for (operation, playlist), details in planned.items():
+            recreated_playlist = details.get("recreated_playlist")
+            if operation == DELETE_OPERATION and recreated_playlist is not None and (operation, playlist) in completed and (UPDATE_OPERATION, recreated_playlist) not in completed:
+                # the diff sees it as a new playlist, it is created again with the same title
+                logging.info("%s was deleted to be recreated from %s, the interrupted sync did not get to create it again\n", playlist, recreated_playlist)
+
+        if planned or completed:
+            pending = sorted("%s %s" % x for x in planned if x not in completed)
+            logging.info("Resuming an interrupted sync, %d operations were completed, pending operations: %s\n", len(completed), pending)
+            SYNC_METRICS.count("journal_operations_recovered", len(completed))
+        return len(completed)
+
+    def is_completed(self, operation, playlist, size, mtime) -> bool:
+        """ Returns True if the interrupted sync completed the operation on the same version of the playlist file. """
+        return self.get_completed(operation, playlist, size, mtime) is not None
+
+    def get_completed(self, operation, playlist, size, mtime):
+        """ Returns the details the interrupted sync completed the operation with, or None if it did not complete it on the same version of the playlist file. """
+        details = self._completed.get((operation, playlist))
+        if details is None or details.get("size") != size or details.get("mtime") != mtime:
+            return None
+        return details
+
+    def plan(self, operation, playlist, **details):
+        self._write({"state": "planned", "operation": operation, "playlist": playlist, **details})
+
+    def complete(self, operation, playlist, **details):
+        self._write({"state": "completed", "operation": operation, "playlist": playlist, **details})
+
+    def close(self, remove=False):
+        """ Closes the journal, and removes it if the sync went through, there is nothing to resume then. """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._completed = dict()
+            if remove and os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _write(self, line):
+        data = json.dumps(line, sort_keys=True) + "\n"
+        with self._lock:
+            if self._file is None:
+                # the journal is only created once there is something to do, the header is only written for a new one
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._file = open(self.path, mode="a+b")
+                if self._file.tell() == 0:
+                    self._file.write((json.dumps({"version": JOURNAL_VERSION, "conversion_signature": self.conversion_signature}, sort_keys=True) + "\n").encode("utf-8"))
+                else:
+                    # ends the line an interrupted sync was writing, so that ours is not glued to it
+                    self._file.seek(-1, os.SEEK_END)
+                    if self._file.read(1) != b"\n":
+                        self._file.write(b"\n")
+            self._file.write(data.encode("utf-8"))
+            self._file.flush()
+            journal_fd = self._file.fileno()
+        # outside of the lock, the other workers can queue their lines while this one hits the disk
+        os.fsync(journal_fd)
+
+    def _parse(self, path):
+        """ Returns the planned and completed operations of the journal, as dicts of (operation, playlist), details. """
+        planned, completed = dict(), dict()
+        if not os.path.isfile(path):
+            return planned, completed
+
+        records = []
+        try:
+            with open(path, mode="r", encoding="utf-8") as journal_file:
+                for line in journal_file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # the line was cut short, we were killed while writing it
+                        continue
+        except OSError as exc:
+            logging.warning("Could not read the sync journal %s, the interrupted sync can't be resumed: %s\n", path, exc)
+            return planned, completed
+
+        if not records or records[0].get("version") != JOURNAL_VERSION or records[0].get("conversion_signature") != self.conversion_signature:
+            if records:
+                logging.info("The sync journal %s is outdated, the interrupted sync won't be resumed\n", path)
+            # the journal starts over
+            os.remove(path)
+            return planned, completed
+
+        for record in records[1:]:
+            operations = completed if record.get("state") == "completed" else planned
+            operations[(record.get("operation"), record.get("playlist"))] = record
+        return planned, completed
@@ -0,0 +1,157 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+
+from SyncMetrics import SYNC_METRICS
+
+MANIFEST_VERSION = 1
+HASH_ALGORITHM = "sha256"
+
+"""
+Class that keeps a local record of every playlist we already pushed to plex.
+Each entry maps the playlist path (relative to the Latest folder) to the content hash, size and mtime of the file we uploaded,
+as well as the ratingKey plex gave the playlist.
+A playlist is only considered changed if its size or mtime moved AND its content hash is different from the one we uploaded.
+The conversion signature lets us invalidate everything at once if the way we convert playlists changes.
+Entries can be recorded from several worker threads at once.
+The manifests of several plex servers can share their <hashes>, so that a playlist is only hashed once for all of them.
+"""
+class PlaylistSyncManifest:
+    def __init__(self, path, conversion_signature="", hashes=None):
+        self.path = path
+        self.conversion_signature = conversion_signature
+        self.entries = self._parse(path)
+        self._hashes = hashes if hashes is not None else dict() # playlist key, (size, mtime, hash) computed during this run
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Returns the manifest entry of the specified playlist or <default> if not found.
+
+            Parameters:
+                key (str): Playlist path relative to the Latest folder.
+                default: Default value to use if key not found.
+        """
+        if key in self.entries:
+            return self.entries[key]
+        else:
+            return default
+
+    def rating_key(self, key):
+        """ Returns the plex ratingKey the playlist was last uploaded as, or None. """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        return entry.get("rating_key")
+
+    def key_of(self, rating_key):
+        """ Returns the playlist that was last uploaded as the plex playlist with the specified ratingKey, or None. """
+        with self._lock:
+            for key, entry in self.entries.items():
+                if str(entry.get("rating_key")) == str(rating_key):
+                    return key
+        return None
+
+    def is_changed(self, key, file_path, size=None, mtime=None) -> bool:
+        """ Returns True if the playlist content differs from what we last uploaded.
+            The size/mtime pass is done first, the file only gets hashed when that pass is inconclusive.
+
+            Parameters:
+                key (str): Playlist path relative to the Latest folder.
+                file_path (str): Full path of the playlist file.
+                size (int): Size of the file if already known, avoids a stat.
+                mtime (float): Modification time of the file if already known, avoids a stat.
+        """
+        entry = self.get(key)
+        if entry is None:
+            return True
+
+        if size is None or mtime is None:
+            stat = os.stat(file_path)
+            size, mtime = stat.st_size, stat.st_mtime
+
+        if entry["size"] == size and entry["mtime"] == mtime:
+            return False
+
+        if entry["size"] != size:
+            return True
+
+        # same size but different mtime, this could be a copy that did not change anything (e.g. FreeFileSync touching the file)
+        if self._hash(key, file_path, size, mtime) != entry["hash"]:
+            return True
+        # the new mtime is recorded, so the file is not hashed again on every run
+        with self._lock:
+            if self.entries.get(key) is entry:
+                self.entries[key] = dict(entry, size=size, mtime=mtime)
+        return False
+
+    def get_version(self, key, file_path, size, mtime) -> dict:
+        """ Returns the content hash of the playlist along with the size and mtime the scan found, to be recorded once the playlist is on plex.
+            It has to be taken before the playlist is read for plex: if the file changes in between, we record an older version than the one we pushed,
+            whose size and mtime no longer match the file, and the playlist is just synced again.
+        """
+        return {"hash": self._hash(key, file_path, size, mtime), "size": size, "mtime": mtime}
+
+    def record(self, key, version, rating_key):
+        """ Records the playlist as uploaded to plex, <version> is the one get_version returned before the playlist was read for plex. """
+        with self._lock:
+            self.entries[key] = dict(version, rating_key=rating_key)
+
+    def restore(self, key, entry):
+        """ Puts back the entry of a playlist that an interrupted sync uploaded, see PlaylistSyncJournal. """
+        with self._lock:
+            self.entries[key] = entry
+
+    def remove(self, key):
+        with self._lock:
+            self.entries.pop(key, None)
+            self._hashes.pop(key, None)
+
+    def prune(self, keys_to_keep):
+        """ Removes the entries of all playlists that are not in <keys_to_keep>. """
+        with self._lock:
+            for key in [x for x in self.entries if x not in keys_to_keep]:
+                self.entries.pop(key, None)
+                self._hashes.pop(key, None)
+
+    def save(self):
+        with self._lock:
+            data = {
+                "version": MANIFEST_VERSION,
+                "conversion_signature": self.conversion_signature,
+                "playlists": dict(self.entries),
+            }
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, mode="w", encoding="utf-8") as json_file:
+            json.dump(data, json_file, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+    def _hash(self, key, file_path, size, mtime) -> str:
+        cached = self._hashes.get(key)
+        if cached is not None and cached[0] == size and cached[1] == mtime:
+            return cached[2]
+
+        with open(file_path, mode="rb") as f:
+            digest = hashlib.file_digest(f, HASH_ALGORITHM).hexdigest()
+        SYNC_METRICS.count("bytes_read", size)
+        self._hashes[key] = (size, mtime, digest)
+        return digest
+
+    def _parse(self, path):
+        if not os.path.isfile(path):
+            return {}
+
+        try:
+            with open(path, mode="r", encoding="utf-8") as json_file:
+                data = json.load(json_file)
+        except (OSError, ValueError) as exc:
+            logging.warning("Could not read the sync manifest %s, every playlist will be synced: %s\n", path, exc)
+            return {}
+
+        if data.get("version") != MANIFEST_VERSION or data.get("conversion_signature") != self.conversion_signature:
+            logging.info("The sync manifest %s is outdated, every playlist will be synced\n", path)
+            return {}
+
+        return data.get("playlists", {})
@@ -0,0 +1,111 @@
+import os
+import queue
+import logging
+import threading
+from collections import namedtuple
+
+PLAYLIST_EXTENSION = ".m3u"
+DEFAULT_MAX_QUEUED = 256
+
+"""
+What we know about a playlist file of the playlists tree.
+folder is relative to the root of the tree, with / separators, and empty for playlists at the root.
+"""
+PlaylistRecord = namedtuple("PlaylistRecord", ["folder", "name", "size", "mtime"])
+
+"""
+Returns the path of a playlist relative to the root of the playlists tree, which is the key we use for it everywhere.
+"""
+def get_playlist_relative_path(folder, name) -> str:
+    return folder + "/" + name + PLAYLIST_EXTENSION if folder else name + PLAYLIST_EXTENSION
+
+"""
+Walks the playlists tree at any depth and yields a (relative path, PlaylistRecord) pair for every playlist as soon as it is found.
+It relies on os.scandir, so the type of each entry comes with the directory listing,
+and on windows (including network shares) so do the size and mtime, so we don't pay a stat round trip per file.
+A folder that can't be listed raises its OSError, the playlists of a partial scan would be taken for deleted playlists.
+"""
+def iter_playlist_tree(root_dir):
+    pending_folders = [""]
+    while pending_folders:
+        folder = pending_folders.pop()
+        folder_path = os.path.join(root_dir, folder) if folder else root_dir
+        try:
+            entries = os.scandir(folder_path)
+        except OSError as exc:
+            logging.error("Could not list %s: %s\n", folder_path, exc)
+            raise
+
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending_folders.append(folder + "/" + entry.name if folder else entry.name)
+                elif entry.is_file():
+                    name, extension = os.path.splitext(entry.name)
+                    if extension != PLAYLIST_EXTENSION:
+                        logging.warning("We have files that are not %s: %s\n", PLAYLIST_EXTENSION, entry.path)
+                        continue
+                    stat = entry.stat()
+                    yield get_playlist_relative_path(folder, name), PlaylistRecord(folder, name, stat.st_size, stat.st_mtime)
+
+"""
+Indexes the whole playlists tree, returns a dict of relative path, PlaylistRecord.
+"""
+def index_playlist_tree(root_dir) -> dict:
+    return dict(iter_playlist_tree(root_dir))
+
+"""
+Class that scans the playlists tree once for several consumers (the plex servers we sync), each one iterates over the playlists with consumer().
+A thread walks the tree and hands every playlist it finds to each consumer through its own bounded queue,
+so the consumers start as soon as the first playlists are found, and the slowest one holds back the scan instead of the playlists piling up.
+A consumer that stops early has to be closed, the others go on without it.
+If the scan fails, the consumers raise its error once they reach the playlists that could not be read, so that none of them takes a partial scan for the whole tree.
+"""
+class PlaylistTreeFanOut:
+    def __init__(self, root_dir, consumers_count, max_queued=DEFAULT_MAX_QUEUED):
+        self.root_dir = root_dir
+        self._queues = [queue.Queue(maxsize=max_queued) for _ in range(consumers_count)]
+        self._closed = [threading.Event() for _ in range(consumers_count)]
+        self._error = None
+        self._thread = threading.Thread(target=self._scan, name="playlist_tree_scan", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def consumer(self, index):
+        """ Yields the (relative path, PlaylistRecord) pairs of the tree, like iter_playlist_tree. """
+        playlists_queue = self._queues[index]
+        try:
+            while True:
+                item = playlists_queue.get()
+                if item is None:
+                    break
+                yield item
+        finally:
+            self.close(index)
+        if self._error is not None:
+            raise self._error
+
+    def close(self, index):
+        self._closed[index].set()
+
+    def _scan(self):
+        try:
+            for item in iter_playlist_tree(self.root_dir):
+                for playlists_queue, closed in zip(self._queues, self._closed):
+                    self._put(playlists_queue, closed, item)
+        except Exception as exc:
+            logging.error("Failed to scan %s: %s\n", self.root_dir, exc)
+            self._error = exc
+        finally:
+            for playlists_queue, closed in zip(self._queues, self._closed):
+                self._put(playlists_queue, closed, None)
+
+    def _put(self, playlists_queue, closed, item):
+        # a consumer that is closed won't empty its queue anymore
+        while not closed.is_set():
+            try:
+                playlists_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
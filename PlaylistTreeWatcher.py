@@ -0,0 +1,175 @@
+import os
+import time
+import logging
+import threading
+
+from PlaylistTreeIndexer import PLAYLIST_EXTENSION, PlaylistRecord, iter_playlist_tree, get_playlist_relative_path
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError: # watchdog is optional, we fall back to polling without it
+    Observer = None
+    FileSystemEventHandler = object
+
+DEFAULT_DEBOUNCE_SECONDS = 15
+DEFAULT_POLL_INTERVAL_SECONDS = 10
+
+"""
+Returns True if the path is on a network share, where filesystem notifications can't be trusted.
+"""
+def is_network_path(path) -> bool:
+    return path.startswith(("//", "\\\\"))
+
+"""
+Collects the paths touched by filesystem notifications until the watcher picks them up.
+"""
+class _PlaylistEventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory and event.event_type == "modified":
+            # the folder of every modified playlist gets one of those, the playlist itself is reported on its own
+            return
+        paths = [event.src_path]
+        if getattr(event, "dest_path", None):
+            paths.append(event.dest_path)
+        self.watcher._notify(paths)
+
+"""
+Class that watches the playlists tree and reports the playlists that changed, in debounced batches.
+It relies on filesystem notifications when watchdog is installed and the tree is local,
+and otherwise polls the tree with the scandir indexer, comparing the size and mtime of every playlist with the previous pass.
+A batch is only reported once no change happened for <debounce_seconds>, so a whole FreeFileSync run ends up in one batch.
+"""
+class PlaylistTreeWatcher:
+    def __init__(self, root_dir, debounce_seconds=DEFAULT_DEBOUNCE_SECONDS, poll_interval_seconds=DEFAULT_POLL_INTERVAL_SECONDS, use_polling=None):
+        self.root_dir = root_dir
+        self.debounce_seconds = debounce_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        if use_polling is None:
+            use_polling = Observer is None or is_network_path(root_dir)
+        self.use_polling = use_polling
+        self.playlists = dict(iter_playlist_tree(root_dir)) # relative path, record
+        self._pending_paths = set()
+        self._last_event_time = None
+        self._condition = threading.Condition()
+        self._observer = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if self.use_polling:
+            logging.info("Polling %s for playlist changes every %ss\n", self.root_dir, self.poll_interval_seconds)
+            return
+        logging.info("Watching %s for playlist changes\n", self.root_dir)
+        self._observer = Observer()
+        self._observer.schedule(_PlaylistEventHandler(self), self.root_dir, recursive=True)
+        self._observer.start()
+
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+    def wait_for_changes(self) -> tuple[set[str], set[str]]:
+        """ Blocks until a debounced batch of changes is available.
+            Returns the relative paths of the playlists that were created or modified, and the ones that were removed.
+            self.playlists is up to date with the tree when this returns.
+        """
+        while True:
+            if self.use_polling:
+                changed_playlists, removed_playlists = self._wait_for_polled_changes()
+            else:
+                changed_playlists, removed_playlists = self._wait_for_notified_changes()
+            if changed_playlists or removed_playlists:
+                return changed_playlists, removed_playlists
+
+    def _notify(self, paths):
+        with self._condition:
+            self._pending_paths.update(paths)
+            self._last_event_time = time.monotonic()
+            self._condition.notify_all()
+
+    def _wait_for_notified_changes(self):
+        with self._condition:
+            while not self._pending_paths:
+                self._condition.wait()
+            while True:
+                quiet_time = time.monotonic() - self._last_event_time
+                if quiet_time >= self.debounce_seconds:
+                    break
+                self._condition.wait(self.debounce_seconds - quiet_time)
+            paths = self._pending_paths
+            self._pending_paths = set()
+        return self._refresh_paths(paths)
+
+    def _wait_for_polled_changes(self):
+        changed_playlists, removed_playlists = set(), set()
+        while True:
+            time.sleep(self.poll_interval_seconds if not changed_playlists and not removed_playlists else self.debounce_seconds)
+            try:
+                playlists = dict(iter_playlist_tree(self.root_dir))
+            except OSError:
+                # the share might be back by the next pass, a partial snapshot would report the playlists we could not list as removed
+                continue
+            changed, removed = self._diff_snapshot(playlists)
+            if not changed and not removed:
+                if changed_playlists or removed_playlists:
+                    # nothing moved during the debounce window, the batch is complete
+                    return changed_playlists - removed_playlists, removed_playlists
+                continue
+            changed_playlists = (changed_playlists | changed) - removed
+            removed_playlists = (removed_playlists | removed) - changed
+
+    def _diff_snapshot(self, playlists):
+        changed_playlists = {x for x, y in playlists.items() if self.playlists.get(x) != y}
+        removed_playlists = {x for x in self.playlists if x not in playlists}
+        self.playlists = playlists
+        return changed_playlists, removed_playlists
+
+    def _refresh_paths(self, paths):
+        """ Refreshes only the parts of the tree the notifications pointed at. """
+        playlists = dict(self.playlists)
+        root_dir = os.path.abspath(self.root_dir)
+        for path in paths:
+            relative_path = os.path.relpath(os.path.abspath(path), root_dir).replace("\\", "/")
+            if relative_path == "." or relative_path.startswith(".."):
+                continue
+
+            if os.path.isdir(path):
+                # a whole folder was created or moved in, re-index it
+                prefix = relative_path + "/"
+                for key in [x for x in playlists if x.startswith(prefix)]:
+                    del playlists[key]
+                try:
+                    for key, record in iter_playlist_tree(path):
+                        record = record._replace(folder=relative_path + "/" + record.folder if record.folder else relative_path)
+                        playlists[get_playlist_relative_path(record.folder, record.name)] = record
+                except FileNotFoundError:
+                    # the folder was moved away right after it came in, its playlists are gone
+                    pass
+                continue
+
+            folder, file_name = os.path.split(relative_path)
+            name, extension = os.path.splitext(file_name)
+            if extension == PLAYLIST_EXTENSION:
+                try:
+                    stat = os.stat(path)
+                    playlists[relative_path] = PlaylistRecord(folder, name, stat.st_size, stat.st_mtime)
+                except FileNotFoundError:
+                    playlists.pop(relative_path, None)
+            else:
+                # could be a folder that was deleted or moved out, forget everything that was under it
+                prefix = relative_path + "/"
+                for key in [x for x in playlists if x.startswith(prefix)]:
+                    del playlists[key]
+
+        return self._diff_snapshot(playlists)
@@ -0,0 +1,147 @@
+import re
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from SyncMetrics import SYNC_METRICS
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BACKOFF_SECONDS = 1.0
+DEFAULT_MAX_PENDING = 32
+
+REGEX_PATTERN_PLEX_ERROR_STATUS_CODE = re.compile(r"^\((\d{3})\)")
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+
+"""
+Mounts an http adapter on the session with a connection pool big enough for all of our workers,
+otherwise urllib3 keeps dropping and reopening connections to the plex server.
+"""
+def mount_connection_pool(session, pool_size):
+    from requests.adapters import HTTPAdapter
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+"""
+Returns True if the error is worth retrying, i.e. the plex server or the network might be fine a bit later.
+Non idempotent operations are only retried when the server can't have applied the request:
+the connection could not be opened, or plex turned it away (429). After a read timeout, a dropped connection or a server error, it might have.
+"""
+def is_transient_error(exc, idempotent) -> bool:
+    # only imported once something failed, requests, urllib3 and plexapi are already loaded by then
+    import requests
+    from urllib3.exceptions import MaxRetryError, ConnectTimeoutError
+    from plexapi.exceptions import BadRequest
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        # requests wraps the errors of the connect phase (refused, unreachable) in a MaxRetryError, a connection dropped after sending is a bare ProtocolError
+        reason = exc.args[0] if exc.args else None
+        return idempotent or (isinstance(reason, MaxRetryError) and isinstance(reason.reason, ConnectTimeoutError))
+    if isinstance(exc, requests.exceptions.Timeout):
+        return idempotent
+    if isinstance(exc, BadRequest):
+        result = REGEX_PATTERN_PLEX_ERROR_STATUS_CODE.match(str(exc))
+        return result is not None and int(result.group(1)) in TRANSIENT_STATUS_CODES and (idempotent or int(result.group(1)) == 429)
+    return False
+
+"""
+Class that runs plex api operations on a pool of workers.
+Each operation is retried with an exponential backoff on transient errors.
+Failed operations are collected instead of aborting the whole sync, and reported once everything is done.
+At most max_pending operations can be queued or running at once, submit() blocks until one of them is done,
+which keeps the producers (scanner, converters) from running too far ahead of plex.
+Operations must not submit other operations when the queue is bounded, they could end up waiting on themselves, they can chain them with run() instead.
+"""
+class PlexApiExecutor:
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, max_retries=DEFAULT_MAX_RETRIES, retry_backoff_seconds=DEFAULT_RETRY_BACKOFF_SECONDS, max_pending=DEFAULT_MAX_PENDING,
+                 thread_name_prefix="plex_api"):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.failures = [] # description, exception
+        self._futures = []
+        self._lock = threading.Lock()
+        # None means unbounded
+        self._pending_slots = threading.BoundedSemaphore(max(max_pending, max_workers)) if max_pending else None
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(cancel_pending=exc_type is not None)
+
+    def submit(self, description, fn, *args, idempotent=True, **kwargs):
+        """ Schedules fn(*args, **kwargs) on the pool and returns its future.
+
+            Parameters:
+                description (str): Human readable description of the operation, used for logging and the failures summary.
+                fn: The operation to run.
+                idempotent (bool): False if running the operation twice has a different result than running it once.
+        """
+        if self._pending_slots is not None:
+            if not self._pending_slots.acquire(blocking=False):
+                SYNC_METRICS.count("plex_queue_full")
+                with SYNC_METRICS.phase("plex queue full"):
+                    self._pending_slots.acquire()
+            try:
+                future = self._pool.submit(self._run, description, fn, args, kwargs, idempotent)
+            except BaseException:
+                self._pending_slots.release()
+                raise
+            future.add_done_callback(lambda _: self._pending_slots.release())
+        else:
+            future = self._pool.submit(self._run, description, fn, args, kwargs, idempotent)
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def run(self, description, fn, *args, idempotent=True, **kwargs):
+        """ Runs fn(*args, **kwargs) right away on the calling thread, retried and reported like a submitted operation.
+            Returns its result, or None if it failed.
+        """
+        return self._run(description, fn, args, kwargs, idempotent)
+
+    def wait(self) -> list[tuple[str, Exception]]:
+        """ Waits for all the submitted operations and returns the ones that failed since the last wait. """
+        while True:
+            with self._lock:
+                futures = self._futures
+                self._futures = []
+            if not futures:
+                break
+            # operations can submit other operations, so we loop until nothing is pending
+            wait(futures)
+
+        with self._lock:
+            failures = self.failures
+            self.failures = []
+        if failures:
+            logging.error("%d plex operations failed:\n%s\n", len(failures), "\n".join("  %s: %s" % (x, y) for x, y in failures))
+        return failures
+
+    def shutdown(self, cancel_pending=False):
+        self._pool.shutdown(wait=True, cancel_futures=cancel_pending)
+
+    def _run(self, description, fn, args, kwargs, idempotent):
+        attempt = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as exc:
+                if attempt >= self.max_retries or not is_transient_error(exc, idempotent):
+                    logging.error("%s failed: %s\n", description, exc)
+                    with self._lock:
+                        self.failures.append((description, exc))
+                    SYNC_METRICS.count("plex_operations_failed")
+                    return None
+
+                delay = self.retry_backoff_seconds * (2 ** attempt) * random.uniform(0.5, 1.5)
+                attempt += 1
+                SYNC_METRICS.count("plex_operation_retries")
+                logging.warning("%s failed (%s), retrying in %.1fs (%d/%d)\n", description, exc, delay, attempt, self.max_retries)
+                time.sleep(delay)
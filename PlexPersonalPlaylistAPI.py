@@ -1,39 +1,34 @@
 from __future__ import unicode_literals
 
+import time
+STARTUP_TIME = time.perf_counter()
+
 from builtins import str
 import sys
 import os
 import logging
-import requests
 import argparse
-from datetime import date
-from plexapi.server import PlexServer
+import itertools
+import threading
+from collections import namedtuple
+from contextlib import ExitStack
+from dataclasses import replace
+from concurrent.futures import ThreadPoolExecutor
 
-from CustomPlexConfig import CustomPlexConfig
+# plexapi, requests and watchdog take a while to import, they are only imported by the code that talks to plex or watches the playlists
+from CustomPlexConfig import DEFAULT_CONFIG_FILE, load_settings, get_target_settings
+from PlaylistSyncManifest import PlaylistSyncManifest
+from PlexPlaylistUpdater import create_playlist_from_rating_keys, update_playlist_in_place
+from PlexTrackIndex import PlexTrackIndex
+from MusicStorageSnapshot import MusicStorageSnapshot
+from PlexApiExecutor import PlexApiExecutor, mount_connection_pool
+from PlexPlaylistIndex import PlexPlaylistIndex
+from PlaylistSyncJournal import PlaylistSyncJournal, CONVERT_OPERATION, DELETE_OPERATION, CREATE_OPERATION, UPDATE_OPERATION
+from SharedSyncWork import SharedSyncWork
+from SyncMetrics import SYNC_METRICS
+from PlaylistTreeIndexer import PlaylistRecord, PlaylistTreeFanOut, iter_playlist_tree, get_playlist_relative_path
 import PlaylistEditDetectionAndConversion
 
-#global settings
-
-JSON_DATA_FILE = os.path.join(os.path.dirname(__file__), "PlexServerDefaultConfig.json")
-DEFAULT_PLEX_CONFIG = CustomPlexConfig(JSON_DATA_FILE)
-
-DEFAULT_PLEX_URL = DEFAULT_PLEX_CONFIG.get("plex_url")
-DEFAULT_PLEX_TOKEN = DEFAULT_PLEX_CONFIG.get("plex_token")
-DEFAULT_MUSIC_LIB_SECTION_NAME = DEFAULT_PLEX_CONFIG.get("music_lib_section_name")
-DEFAULT_DAYS_MARGIN_FOR_SYNC = DEFAULT_PLEX_CONFIG.get("sync_days_margin") # number of days allowed for us to consider syncing a playlist, 0 means it has to be today
-DEFAULT_FORCE_SYNC_ALL_PLAYLISTS = DEFAULT_PLEX_CONFIG.get("force_sync_all_playlists")
-
-DEFAULT_PLAYLIST_DIR = DEFAULT_PLEX_CONFIG.get("nvidia_shield_storage_path") + DEFAULT_PLEX_CONFIG.get("nvidia_shield_playlists_relative_root_path") 
-
-DEFAULT_UNMODIFIED_PLAYLISTS_DIR = DEFAULT_PLAYLIST_DIR + "Latest/"
-DEFAULT_CONVERTED_PLAYLISTS_DIR = DEFAULT_PLAYLIST_DIR + "Converted/"
-
-DEFAULT_NVIDIA_SHIELD_MACHINE_ID = DEFAULT_PLEX_CONFIG.get("nvidia_shield_id")
-DEFAULT_NVIDIA_SHIELD_STORAGE_ROOT = "/storage/%s/" % DEFAULT_NVIDIA_SHIELD_MACHINE_ID
-DEFAULT_NVIDIA_SHIELD_PLAYLIST_DIR = DEFAULT_NVIDIA_SHIELD_STORAGE_ROOT + DEFAULT_PLEX_CONFIG.get("nvidia_shield_playlists_relative_root_path")
-
-DEFAULT_PLEX_INTERNAL_CONVERTED_PLAYLISTS_DIR = DEFAULT_NVIDIA_SHIELD_PLAYLIST_DIR + "Converted/"
-
 
 # set up logging
 
@@ -46,7 +41,7 @@ logger.setLevel(logging.DEBUG)
 error_format = logging.Formatter('%(asctime)s:%(name)s:%(funcName)s:%(message)s')
 stream_format = logging.Formatter('%(message)s')
 
-file_handler = logging.FileHandler('{}.log'.format(filename))
+file_handler = logging.FileHandler('{}.log'.format(filename), delay=True) # only created once there is an error to log
 file_handler.setLevel(logging.ERROR)
 file_handler.setFormatter(error_format)
 
@@ -56,137 +51,406 @@ stream_handler.setFormatter(stream_format)
 logger.addHandler(file_handler)
 logger.addHandler(stream_handler)
 
+"""
+The operations of a diff, see iter_playlist_operations. Creates and updates are journaled under the same name.
+"""
+CREATE_PLAYLIST = CREATE_OPERATION
+UPDATE_PLAYLIST = UPDATE_OPERATION
+DELETE_PLAYLISTS = "delete"
+
 """
 Used to check if we have any playlists that need to be created, removed or updated on plex.
-The criterion for a playlist to be updated is that it has been modified within the time frame we specify with DEFAULT_DAYS_MARGIN_FOR_SYNC.
+The criterion for a playlist to be updated is that its content changed since we last uploaded it, according to the sync manifest.
 We can bypass the latter by setting force_sync to true.
+Playlists whose title is shared by several plex playlists are skipped if the manifest can't tell which one is ours.
+The diff is a stream of (operation, relative path, PlaylistRecord) for the playlists to create and update, which are yielded while the tree is still being scanned,
+so they can be converted and pushed to plex without waiting for the end of the scan.
+The titles to remove are only known once the whole tree was scanned, they come last as a single (DELETE_PLAYLISTS, None, titles) operation,
+which is left out if the scan failed: a missing folder stops the diff there, and a folder that can't be listed raises, so a partial tree never wipes the plex playlists.
+When the latest playlists folder was already indexed (watch mode), its records can be passed as synced_playlists to skip the scan,
+and changed_playlists restricts the update check to the playlists we know changed.
+synced_playlists can also be the (relative path, record) pairs of a scan that is still going on, see PlaylistTreeFanOut.
 """
-def diff_playlists(plex_server, music_lib_section_id, unmodified_playlists_dir, force_sync):
-    
-    if not os.path.exists(unmodified_playlists_dir) or not os.path.isdir(unmodified_playlists_dir):
-        logger.error("%s does not exist or is not a directory!\n", unmodified_playlists_dir)
-        return None, None, None
-    
-    synced_playlists_names = dict() #playlist name, folder
-    list_of_files_and_sub_dirs = os.listdir(unmodified_playlists_dir)    
-    for file_or_sub_dir in list_of_files_and_sub_dirs:
-        #todoAiza we can do this better, this goes only one level down, we wanna catch all files in the hierarchy if it goes deeper
-        file_or_sub_dir_path = os.path.join(unmodified_playlists_dir, file_or_sub_dir)
-        if os.path.isfile(file_or_sub_dir_path):
-            synced_playlist_name = file_or_sub_dir.split(".")[0]
-            synced_playlists_names[synced_playlist_name] = ""
-            
-        elif os.path.isdir(file_or_sub_dir_path):
-            list_of_files_and_sub_dirs_under_sub_dir = os.listdir(file_or_sub_dir_path)
-            for sub_dir_file_or_sub_dir in list_of_files_and_sub_dirs_under_sub_dir:
-                sub_file_path = os.path.join(file_or_sub_dir_path, sub_dir_file_or_sub_dir)
-
-                if os.path.isfile(sub_file_path):
-                    synced_playlist_name = sub_dir_file_or_sub_dir.split(".")[0]
-                    synced_playlists_names[synced_playlist_name] = file_or_sub_dir
-                else:
-                    logger.error("The directories hierarchy is deeper than one level in %s!\n" % sub_file_path)
-
-    
-    if len(synced_playlists_names) == 0:
+def iter_playlist_operations(playlist_index, unmodified_playlists_dir, manifest, force_sync, synced_playlists=None, changed_playlists=None):
+    
+    if synced_playlists is None:
+        if not os.path.exists(unmodified_playlists_dir) or not os.path.isdir(unmodified_playlists_dir):
+            logger.error("%s does not exist or is not a directory!\n", unmodified_playlists_dir)
+            return
+        synced_playlists = iter_playlist_tree(unmodified_playlists_dir) #relative path, record
+    elif isinstance(synced_playlists, dict):
+        synced_playlists = sorted(synced_playlists.items())
+    
+    # plex playlists are identified by their title, so two playlists with the same name in different folders can't both be synced, the first one found wins
+    synced_playlists_titles = dict() #playlist name, relative path
+    for playlist_key, playlist_record in synced_playlists:
+        if playlist_record.name in synced_playlists_titles:
+            logger.error("Skipping playlist: %s, its name is already used by: %s\n" % (playlist_key, synced_playlists_titles[playlist_record.name]))
+            SYNC_METRICS.count("playlists_skipped")
+            continue
+        synced_playlists_titles[playlist_record.name] = playlist_key
+        operation = get_playlist_operation(playlist_index, unmodified_playlists_dir, manifest, force_sync, playlist_key, playlist_record, changed_playlists)
+        if operation is not None:
+            yield operation, playlist_key, playlist_record
+    
+    if len(synced_playlists_titles) == 0:
         logger.error("%s does not contain any playlist files!\n", unmodified_playlists_dir)
-        return None, None, None
+        return
     
-    plex_music_playlists_names = [x.title for x in plex_server.playlists(playlistType="audio", sectionId=music_lib_section_id)]
+    # forget about the playlists that are not in the latest playlists folder anymore
+    manifest.prune(set(synced_playlists_titles.values()))
     
     #!playlists to remove: in plex but not in the latest playlists folder
-    playlists_to_remove = [x for x in plex_music_playlists_names if x not in synced_playlists_names]
+    yield DELETE_PLAYLISTS, None, [x for x in playlist_index.titles() if x not in synced_playlists_titles]
+
+
+"""
+Returns whether a playlist of the latest playlists folder has to be created or updated, or None if plex is up to date with it.
+If changed_playlists is specified, only those are checked for updates.
+"""
+def get_playlist_operation(playlist_index, unmodified_playlists_dir, manifest, force_sync, playlist_key, playlist_record, changed_playlists=None):
     
     #!playlists to create: in the latest playlists folder but not in plex
-    playlists_to_create = dict()
+    if playlist_record.name not in playlist_index:
+        return CREATE_PLAYLIST
+    
     #!playlists to update: in both plex and latest playlists folder
-    playlists_to_update = dict()
+    if changed_playlists is not None and playlist_key not in changed_playlists:
+        return None
+    if playlist_index.find(playlist_record.name, manifest.rating_key(playlist_key)) is None:
+        logger.error("Skipping the update of playlist: %s\n" % playlist_record.name)
+        SYNC_METRICS.count("playlists_skipped")
+        return None
     
-    for playlist_name, playlist_folder in synced_playlists_names.items():
-        if playlist_name not in plex_music_playlists_names:
-            playlists_to_create[playlist_name] = playlist_folder
-        else:
-            playlist_path = os.path.join(unmodified_playlists_dir, playlist_folder, playlist_name + ".m3u")
-            file_updated_date = date.fromtimestamp(os.path.getmtime(playlist_path))
-            time_today = date.today()
-            time_since_last_updated = time_today - file_updated_date
-            if force_sync or time_since_last_updated.days <= DEFAULT_DAYS_MARGIN_FOR_SYNC:
-                playlists_to_update[playlist_name] = playlist_folder
+    playlist_path = os.path.join(unmodified_playlists_dir, playlist_key)
+    if force_sync or manifest.is_changed(playlist_key, playlist_path, playlist_record.size, playlist_record.mtime):
+        return UPDATE_PLAYLIST
+    SYNC_METRICS.count("playlists_unchanged")
+    return None
+
+
+"""
+Same as iter_playlist_operations, but only for the playlists that freefilesync logged as changed or removed, so the latest playlists folder is not scanned.
+The titles to remove are known upfront, so their deletion comes first.
+Only the logged playlists are known here, so on top of the first-wins check of the full scan,
+a playlist is skipped if its title belongs to a plex playlist the manifest records for another playlist of the tree.
+"""
+def iter_logged_playlist_operations(playlist_index, unmodified_playlists_dir, manifest, force_sync, changed_playlists, removed_playlists):
+    
+    logged_playlists = dict() #relative path, record
+    for playlist_key in changed_playlists:
+        playlist_folder, _, playlist_file_name = playlist_key.rpartition("/")
+        try:
+            stat = os.stat(os.path.join(unmodified_playlists_dir, playlist_key))
+        except OSError:
+            logger.warning("%s was logged as changed but could not be found!\n" % playlist_key)
+            continue
+        logged_playlists[playlist_key] = PlaylistRecord(playlist_folder, os.path.splitext(playlist_file_name)[0], stat.st_size, stat.st_mtime)
+    
+    logged_playlists_titles = {x.name for x in logged_playlists.values()}
+    playlists_to_remove = []
+    for playlist_key in removed_playlists:
+        manifest.remove(playlist_key)
+        playlist_name = os.path.splitext(playlist_key.rpartition("/")[2])[0]
+        # a playlist that was moved to another folder keeps its title
+        if playlist_name in playlist_index and playlist_name not in logged_playlists_titles:
+            playlists_to_remove.append(playlist_name)
+    yield DELETE_PLAYLISTS, None, playlists_to_remove
+    
+    logged_playlists_keys = dict() #playlist name, relative path
+    for playlist_key, playlist_record in sorted(logged_playlists.items()):
+        if playlist_record.name in logged_playlists_keys:
+            logger.error("Skipping playlist: %s, its name is already used by: %s\n" % (playlist_key, logged_playlists_keys[playlist_record.name]))
+            SYNC_METRICS.count("playlists_skipped")
+            continue
+        logged_playlists_keys[playlist_record.name] = playlist_key
+        owners = {manifest.key_of(x.ratingKey) for x in playlist_index.get_all(playlist_record.name)} - {None}
+        if owners and playlist_key not in owners:
+            logger.error("Skipping playlist: %s, its name is already used by: %s, run a full sync if it was moved\n" % (playlist_key, ", ".join(sorted(owners))))
+            SYNC_METRICS.count("playlists_skipped")
+            continue
+        operation = get_playlist_operation(playlist_index, unmodified_playlists_dir, manifest, force_sync, playlist_key, playlist_record)
+        if operation is not None:
+            yield operation, playlist_key, playlist_record
+
+
+"""
+Deletes a playlist from plex, a playlist that is already gone counts as deleted, so retrying is safe.
+Returns True once the playlist is gone.
+"""
+def delete_playlist(playlist_index, playlist_obj, journal=None):
     
-    return playlists_to_create, playlists_to_update, playlists_to_remove
+    from plexapi.exceptions import NotFound
+    
+    logger.info("Requesting the deletion of playlist: %s\n" % playlist_obj.title)
+    try:
+        playlist_obj.delete()
+        SYNC_METRICS.count("playlists_deleted")
+    except NotFound:
+        logger.warning("Could not find playlist: %s\n" % playlist_obj.title)
+    playlist_index.remove(playlist_obj)
+    if journal is not None:
+        journal.complete(DELETE_OPERATION, playlist_obj.title, rating_key=playlist_obj.ratingKey)
+    return True
 
 
-def delete_playlists(plex_server, playlists_to_delete):
+"""
+Deletes every plex playlist with one of the specified titles, duplicates included.
+"""
+def delete_playlists(playlist_index, playlists_to_delete, executor, journal=None):
     
     for playlist in playlists_to_delete:
-        playlist_obj = plex_server.playlist(title=playlist)
-        if playlist_obj is not None:
-            logger.info("Requesting the deletion of playlist: %s\n" % playlist)
-            playlist_obj.delete()
-        else:
-            logger.warning("Could not find playlist: %s\n" % playlist)
+        for playlist_obj in playlist_index.get_all(playlist):
+            if journal is not None:
+                journal.plan(DELETE_OPERATION, playlist, rating_key=playlist_obj.ratingKey)
+            executor.submit("Deleting playlist: %s" % playlist, delete_playlist, playlist_index, playlist_obj, journal)
 
       
         
-def create_or_update_playlists(plex_server, music_lib_section, playlists, unmodified_playlists_dir, converted_playlists_dir):
+"""
+Returns the full paths of a playlist in the latest playlists folder and in the converted playlists folder.
+"""
+def get_playlist_paths(playlist_name, playlist_folder, unmodified_playlists_dir, converted_playlists_dir) -> tuple[str, str]:
+    playlist_full_path = os.path.join(unmodified_playlists_dir, playlist_folder, playlist_name + ".m3u").replace("\\","/")
+    converted_playlist_full_path = os.path.join(converted_playlists_dir, playlist_folder, playlist_name + ".m3u").replace("\\","/")
+    return playlist_full_path, converted_playlist_full_path
+
+
+"""
+Loads the track index and brings it up to date with the music section, sync_playlists runs it in the background while the playlists are scanned.
+"""
+def refresh_track_index(plex, music_lib_section, settings) -> PlexTrackIndex:
     
-    for playlist_name, playlist_folder in playlists.items():
-        playlist_full_path = os.path.join(unmodified_playlists_dir, playlist_folder, playlist_name + ".m3u").replace("\\","/")
-        converted_playlist_full_path = os.path.join(converted_playlists_dir, playlist_folder, playlist_name + ".m3u").replace("\\","/")
-        logger.debug("Converting the playlist: %s to: %s\n" % (playlist_full_path, converted_playlist_full_path))
-        PlaylistEditDetectionAndConversion.convert_playlist_for_plex(playlist_full_path, converted_playlist_full_path)
-        
-        plex_internal_storage_converted_playlist_full_path = os.path.join(DEFAULT_PLEX_INTERNAL_CONVERTED_PLAYLISTS_DIR, playlist_folder, playlist_name + ".m3u").replace("\\","/")
+    track_index = PlexTrackIndex(settings.track_index_file)
+    with SYNC_METRICS.phase("track index refresh"):
+        track_index.refresh(plex, music_lib_section)
+    return track_index
+
+
+"""
+Loads the music snapshot and brings it up to date with the music tree, sync_playlists runs it in the background while the playlists are scanned.
+Returns None if the music tree could not be read, the tracks are not checked then.
+"""
+def refresh_music_snapshot(settings):
+    
+    music_snapshot = MusicStorageSnapshot(settings.music_snapshot_file, settings.local_music_dir)
+    with SYNC_METRICS.phase("music snapshot refresh"):
+        music_snapshot.refresh(settings.music_snapshot_max_workers)
+        if not music_snapshot.available:
+            return None
+        try:
+            music_snapshot.save()
+        except OSError as exc:
+            logger.warning("Could not save the music snapshot: %s\n" % exc)
+    return music_snapshot
+
+
+"""
+Waits for a refresh that sync_playlists started in the background, returns None if it was not started.
+"""
+def wait_for_refresh(refresh_future):
+    return refresh_future.result() if refresh_future is not None else None
+
+
+"""
+Logs the tracks of a playlist that are missing from the music tree, or that are not in the music folder plex knows at all, plex would silently drop them.
+"""
+def check_playlist_tracks(music_snapshot, playlist_key, tracks, settings):
+    
+    missing_tracks, unmapped_tracks = music_snapshot.check_playlist(playlist_key, tracks, settings.nvidia_shield_music_dir)
+    if missing_tracks:
+        logger.warning("%d tracks of playlist: %s are missing from %s: %s\n" % (len(missing_tracks), playlist_key, settings.local_music_dir, missing_tracks))
+    if unmapped_tracks:
+        logger.warning("%d tracks of playlist: %s are not under %s: %s\n" % (len(unmapped_tracks), playlist_key, settings.nvidia_shield_music_dir, unmapped_tracks))
+
+
+"""
+What a plex operation needs to push a playlist: the plex server and its music section, its playlist index, the name, folder and full path of the playlist,
+the sync manifest, the futures of the track index and music snapshot refreshes, and the sync settings.
+"""
+PlaylistPush = namedtuple("PlaylistPush", ["plex", "music_lib_section", "playlist_index", "playlist_name", "playlist_folder", "playlist_full_path", "manifest",
+                                           "track_index_future", "music_snapshot_future", "settings"])
+
+
+"""
+Creates a playlist on plex.
+With the track index, the playlist is built from the ratingKeys of its tracks, otherwise plex is given the path of the already converted m3u file to upload.
+The track index and the music snapshot of <playlist_push> are the futures of their background refresh, or None when they are not needed.
+The playlist_version is the one the manifest records, taken before the playlist was read, see PlaylistSyncManifest.get_version.
+Returns True once the playlist is on plex, False if it was skipped.
+"""
+def create_playlist(playlist_push, playlist_version):
+    
+    plex_server, playlist_name, playlist_folder, settings = playlist_push.plex, playlist_push.playlist_name, playlist_push.playlist_folder, playlist_push.settings
+    track_index_future, music_snapshot_future = playlist_push.track_index_future, playlist_push.music_snapshot_future
+    track_index = wait_for_refresh(track_index_future) if settings.use_track_index else None
+    music_snapshot = wait_for_refresh(music_snapshot_future)
+    if settings.use_track_index or music_snapshot is not None:
+        tracks = PlaylistEditDetectionAndConversion.read_converted_playlist_tracks(playlist_push.playlist_full_path, settings.path_rewriter)
+        if tracks is None:
+            return False
+        if music_snapshot is not None:
+            check_playlist_tracks(music_snapshot, get_playlist_relative_path(playlist_folder, playlist_name), tracks, settings)
+    
+    if settings.use_track_index:
+        rating_keys, unresolved_tracks = track_index.resolve(tracks)
+        if unresolved_tracks:
+            logger.warning("Could not find %d tracks of playlist: %s in plex: %s\n" % (len(unresolved_tracks), playlist_name, unresolved_tracks))
+        if not rating_keys:
+            logger.error("Skipping playlist: %s, none of its tracks are in plex\n" % playlist_name)
+            SYNC_METRICS.count("playlists_skipped")
+            return False
+        logger.info("Requesting the creation of playlist: %s from %d tracks\n" % (playlist_name, len(rating_keys)))
+        playlist_obj = create_playlist_from_rating_keys(plex_server, playlist_name, rating_keys)
+    else:
+        plex_internal_storage_converted_playlist_full_path = os.path.join(settings.plex_internal_converted_playlists_dir, playlist_folder, playlist_name + ".m3u").replace("\\","/")
         logger.info("Requesting the creation of playlist: %s\n" % (plex_internal_storage_converted_playlist_full_path))
-        plex_server.createPlaylist(title=playlist_name, section=music_lib_section, m3ufilepath=plex_internal_storage_converted_playlist_full_path)
+        playlist_obj = plex_server.createPlaylist(title=playlist_name, section=playlist_push.music_lib_section, m3ufilepath=plex_internal_storage_converted_playlist_full_path)
+    
+    playlist_push.playlist_index.add(playlist_obj)
+    playlist_push.manifest.record(get_playlist_relative_path(playlist_folder, playlist_name), playlist_version, playlist_obj.ratingKey)
+    SYNC_METRICS.count("playlists_created")
+    return True
         
 
-def parse_args():
+"""
+Updates a playlist that already exists on plex in place, by only adding, removing and moving the tracks that changed, which keeps its ratingKey stable.
+The changes are diffed against what is currently on plex, so retrying an update that partly went through is safe.
+Playlists that can't be updated in place are deleted and recreated instead, see submit_playlist_operation.
+The arguments are the ones of create_playlist.
+Returns True once the new version of the playlist is on plex, False if it was skipped.
+"""
+def update_playlist(playlist_push, playlist_version):
     
-    # Instantiate the parser
-    parser = argparse.ArgumentParser(description="Upload playlists to Plex")
+    playlist_name, playlist_folder, manifest, settings = playlist_push.playlist_name, playlist_push.playlist_folder, playlist_push.manifest, playlist_push.settings
+    playlist_obj = playlist_push.playlist_index.find(playlist_name, manifest.rating_key(get_playlist_relative_path(playlist_folder, playlist_name)))
+    if playlist_obj is None:
+        logger.error("Skipping the update of playlist: %s, it is not on plex anymore\n" % playlist_name)
+        SYNC_METRICS.count("playlists_skipped")
+        return False
     
-    # Add arguments
-    parser.add_argument("-u", "--plex_url", type=str, default=DEFAULT_PLEX_URL, help="The Plex URL")
-    parser.add_argument("-t", "--plex_token", type=str, default=DEFAULT_PLEX_TOKEN, help="The Plex Token")
-    parser.add_argument("-s", "--music_lib_section_name", default=DEFAULT_MUSIC_LIB_SECTION_NAME, type=str, help="The Plex Music Library Section Name")
-    parser.add_argument("-d", "--playlists_dir", type=str, default=DEFAULT_PLAYLIST_DIR, help="The Playlists Directory Path")
-    parser.add_argument("-f", "--force_sync", action=argparse.BooleanOptionalAction, help="If added, we ignore the log files and just look at the playlists folder")
+    track_index = wait_for_refresh(playlist_push.track_index_future)
+    music_snapshot = wait_for_refresh(playlist_push.music_snapshot_future)
+    new_tracks = PlaylistEditDetectionAndConversion.read_converted_playlist_tracks(playlist_push.playlist_full_path, settings.path_rewriter)
+    if new_tracks is None:
+        return False
+    if music_snapshot is not None:
+        check_playlist_tracks(music_snapshot, get_playlist_relative_path(playlist_folder, playlist_name), new_tracks, settings)
     
-    return parser.parse_args()
+    logger.info("Requesting the update of playlist: %s\n" % playlist_name)
+    changes_count = update_playlist_in_place(playlist_push.plex, playlist_obj, new_tracks, track_index)
+    logger.debug("Applied %d changes to playlist: %s\n" % (changes_count, playlist_name))
+    manifest.record(get_playlist_relative_path(playlist_folder, playlist_name), playlist_version, playlist_obj.ratingKey)
+    SYNC_METRICS.count("playlists_updated")
+    SYNC_METRICS.count("playlist_track_changes", changes_count)
+    return True
 
 
-def main():
-        
-    args = parse_args()
+"""
+Creates a playlist again once its previous version was deleted, see delete_and_recreate_playlist, the arguments are the ones of create_playlist.
+"""
+def recreate_playlist(playlist_push, playlist_version):
     
-    plex_url = DEFAULT_PLEX_URL
-    if args.plex_url:
-        plex_url = args.plex_url
-        logger.info("Using Plex URL: {}".format(plex_url))
-        
-    plex_token = DEFAULT_PLEX_TOKEN
-    if args.plex_token:
-        plex_token = args.plex_token
-        logger.info("Using Plex Token: {}".format(plex_token))
-    
-    music_lib_section_name = DEFAULT_MUSIC_LIB_SECTION_NAME
-    if args.music_lib_section_name:
-        music_lib_section_name = args.music_lib_section_name
-        logger.info("Using Music Library Section Name: {}".format(music_lib_section_name))
-        
-    playlists_dir = DEFAULT_PLAYLIST_DIR
-    if args.playlists_dir:
-        playlists_dir = args.playlists_dir
-        logger.info("Using Playlists Directory: {}".format(playlists_dir))
+    if not create_playlist(playlist_push, playlist_version):
+        return False
+    SYNC_METRICS.count("playlists_recreated")
+    return True
+
+
+"""
+Runs create_playlist, update_playlist or recreate_playlist, and marks the operation as completed in the journal once the playlist is on plex, along with its manifest entry.
+Without a playlist_version, the playlist was not converted beforehand and the plex operation reads it, its version is taken right before.
+"""
+def push_playlist(journal, operation, playlist_key, playlist_record, playlist_version, playlist_operation, playlist_push):
+    
+    manifest = playlist_push.manifest
+    if playlist_version is None:
+        playlist_version = manifest.get_version(playlist_key, playlist_push.playlist_full_path, playlist_record.size, playlist_record.mtime)
+    if not playlist_operation(playlist_push, playlist_version):
+        return
+    journal.complete(operation, playlist_key, size=playlist_version["size"], mtime=playlist_version["mtime"], entry=manifest.get(playlist_key))
+
+
+"""
+Submits the plex operation of a playlist to create or update, <playlist_push> is passed on to create_playlist or update_playlist, and so is the playlist_version,
+which is None if the playlist was not converted beforehand, see push_playlist.
+Playlists that can't be updated in place (incremental updates disabled, smart playlists) are deleted and recreated by a single operation, see delete_and_recreate_playlist.
+"""
+def submit_playlist_operation(executor, journal, operation, playlist_key, playlist_record, playlist_push, playlist_version=None):
+    
+    playlist_index, playlist_name = playlist_push.playlist_index, playlist_push.playlist_name
+    if operation == UPDATE_PLAYLIST:
+        playlist_obj = playlist_index.find(playlist_name, playlist_push.manifest.rating_key(playlist_key))
+        if playlist_push.settings.incremental_update and playlist_obj is not None and not playlist_obj.smart:
+            executor.submit("Updating playlist: %s" % playlist_name, push_playlist, journal, operation, playlist_key, playlist_record, playlist_version, update_playlist,
+                            playlist_push)
+            return
         
-    force_sync = DEFAULT_FORCE_SYNC_ALL_PLAYLISTS
-    if args.force_sync:
-        force_sync = args.force_sync
-        logger.info("Using Force Sync All Playlists: {}".format(force_sync))
+        if playlist_obj is not None:
+            if playlist_push.settings.incremental_update:
+                logger.warning("Can not update playlist: %s in place, it will be recreated\n" % playlist_name)
+            # journaled along with the playlist it is recreated for, a resumed sync can tell it from a playlist that was removed
+            journal.plan(DELETE_OPERATION, playlist_name, rating_key=playlist_obj.ratingKey, recreated_playlist=playlist_key)
+            executor.submit("Recreating playlist: %s" % playlist_name, delete_and_recreate_playlist, executor, journal, operation, playlist_key, playlist_record, playlist_version,
+                            playlist_obj, playlist_push, idempotent=False)
+            return
+        playlist_operation = recreate_playlist
+    else:
+        playlist_operation = create_playlist
+    # creating a playlist twice would leave us with a duplicate, so we only retry it if plex can't have received it
+    executor.submit("Creating playlist: %s" % playlist_name, push_playlist, journal, operation, playlist_key, playlist_record, playlist_version, playlist_operation,
+                    playlist_push, idempotent=False)
+
+
+"""
+Deletes the previous version of a playlist and creates it again, as one plex operation so that only the create waits for the delete, the scan and the conversions don't.
+Both are run inline with the retries of their own operation, the create is not retried if plex might have received it, see submit_playlist_operation.
+"""
+def delete_and_recreate_playlist(executor, journal, operation, playlist_key, playlist_record, playlist_version, playlist_obj, playlist_push):
+    
+    playlist_name = playlist_push.playlist_name
+    # the new playlist must not be created next to the one it replaces
+    if not executor.run("Deleting playlist: %s" % playlist_name, delete_playlist, playlist_push.playlist_index, playlist_obj, journal):
+        return
+    executor.run("Creating playlist: %s" % playlist_name, push_playlist, journal, operation, playlist_key, playlist_record, playlist_version, recreate_playlist, playlist_push,
+                 idempotent=False)
+
 
-    unmodified_playlists_dir = playlists_dir + "Latest/"
-    converted_playlists_dir = playlists_dir + "Converted/"    
+"""
+Converts a playlist for plex and submits its plex operation, runs on the conversion pool of sync_playlists.
+The conversion is skipped if the interrupted sync we are resuming already converted the same version of the playlist.
+The version the manifest records is taken before the conversion reads the playlist, and kept in the journal for a resumed conversion.
+Submitting blocks while the plex queue is full, which holds back the conversion of the next playlists.
+"""
+def convert_and_submit_playlist(executor, journal, shared_work, operation, playlist_key, playlist_record, playlist_push, converted_playlist_full_path, settings):
+    
+    playlist_name, playlist_full_path, manifest = playlist_push.playlist_name, playlist_push.playlist_full_path, playlist_push.manifest
+    try:
+        conversion = journal.get_completed(CONVERT_OPERATION, playlist_key, playlist_record.size, playlist_record.mtime)
+        if conversion is not None and conversion.get("hash") is not None and os.path.isfile(converted_playlist_full_path):
+            playlist_version = {"hash": conversion["hash"], "size": playlist_record.size, "mtime": playlist_record.mtime}
+            SYNC_METRICS.count("conversions_resumed")
+        else:
+            playlist_version = manifest.get_version(playlist_key, playlist_full_path, playlist_record.size, playlist_record.mtime)
+            if shared_work.convert_playlist(playlist_full_path, converted_playlist_full_path, settings.path_rewriter, playlist_record.size, playlist_record.mtime) is None:
+                logger.error("Skipping playlist: %s, its conversion failed\n" % playlist_name)
+                SYNC_METRICS.count("playlists_skipped")
+                return
+            journal.complete(CONVERT_OPERATION, playlist_key, size=playlist_record.size, mtime=playlist_record.mtime, hash=playlist_version["hash"])
+        submit_playlist_operation(executor, journal, operation, playlist_key, playlist_record, playlist_push, playlist_version)
+    except Exception as exc:
+        logger.error("Skipping playlist: %s, it could not be submitted to plex: %s\n" % (playlist_name, exc))
+        SYNC_METRICS.count("playlists_skipped")
+
+
+"""
+Connects to the plex server and looks for the music section.
+Returns the server and the music section, which is None if it was not found.
+"""
+def connect_to_plex(plex_url, plex_token, music_lib_section_name, max_workers):
+    
+    import requests
+    from plexapi.server import PlexServer
     
     sess = requests.Session()
     # Ignore verifying the SSL certificate
@@ -198,47 +462,352 @@ def main():
         # Disable the warning that the request is insecure, we know that...
         import urllib3
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    mount_connection_pool(sess, max_workers)
+    SYNC_METRICS.install_session_hook(sess)
 
     plex = PlexServer(plex_url, plex_token, session=sess)
     
     # validate the existence of the music section
     sections = plex.library.sections()
-    sections_dict = dict()
     music_lib_section = None
     for section in sections:
-        sections_dict[section.key] = section.title
         if section.title == music_lib_section_name:
             assert music_lib_section is None
             music_lib_section = section
 
+    return plex, music_lib_section
+
+
+"""
+What we need to sync the playlists to one plex server: its settings, its connection and music section, its playlist index, its sync manifest and its executor.
+"""
+SyncTarget = namedtuple("SyncTarget", ["settings", "plex", "music_lib_section", "playlist_index", "manifest", "executor"])
+
+
+"""
+Names the worker threads after the target they work for, the log lines of a sync to several targets start with the name of their thread.
+"""
+def get_thread_name_prefix(prefix, settings) -> str:
+    return "%s_%s" % (prefix, settings.target_name) if settings.target_name else prefix
+
+
+"""
+Connects to the plex server of a target and loads what we know about it: its playlists and its sync manifest.
+The manifests of all targets share <playlist_hashes>, so each playlist is only hashed once.
+Returns None if the music section was not found.
+"""
+def open_sync_target(target_settings, executor, playlist_hashes):
+    
+    start_time = time.perf_counter()
+    with SYNC_METRICS.phase("connect"):
+        plex, music_lib_section = connect_to_plex(target_settings.plex_url, target_settings.plex_token, target_settings.music_lib_section_name,
+                                                  target_settings.plex_api_max_workers)
+    logger.debug("Connected to plex {} in {:.3f}s\n".format(target_settings.plex_url, time.perf_counter() - start_time))
     if music_lib_section is None:
-        logger.error("Music Library Section Name \"{}\" not found!\n".format(music_lib_section_name))
+        logger.error("Music Library Section Name \"{}\" not found on {}!\n".format(target_settings.music_lib_section_name, target_settings.plex_url))
+        return None
+    
+    manifest = PlaylistSyncManifest(target_settings.sync_manifest_file, PlaylistEditDetectionAndConversion.get_conversion_signature(target_settings.path_rewriter),
+                                    playlist_hashes)
+    with SYNC_METRICS.phase("plex playlists listing"):
+        playlist_index = PlexPlaylistIndex.fetch(plex, music_lib_section.key)
+    return SyncTarget(target_settings, plex, music_lib_section, playlist_index, manifest, executor)
+
+
+"""
+Applies the operations of a diff to plex, see iter_playlist_operations.
+Returns the plex operations that failed.
+The sync runs as a pipeline: the playlists to create and update are dispatched as the diff yields them, while the tree is still being scanned.
+Each one is converted on the conversion pool, which submits its plex operation once it is done,
+and with the track index there is nothing to convert, the plex workers read the playlists themselves.
+Both the conversion pool and the plex queue are bounded, so a slow stage holds back the ones before it instead of piling up work.
+The track index and the music snapshot are refreshed in the background as soon as a playlist needs them, the plex operations wait for them.
+Deletes, creates and updates never target the same playlist title, so they all run at the same time.
+Every operation goes through the journal, if the sync is interrupted the next one puts back what was done and only redoes what was pending.
+When several plex servers are synced at once, they share the conversions and the refreshes through <shared_work>.
+"""
+def sync_playlists(plex, music_lib_section, playlist_index, manifest, executor, playlist_operations, settings, shared_work=None):
+    
+    # before the diff, it relies on the manifest
+    journal = PlaylistSyncJournal(settings.sync_journal_file, manifest.conversion_signature)
+    journal.recover(manifest)
+    synced = False
+    if shared_work is None:
+        shared_work = SharedSyncWork()
+    refresh_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix=get_thread_name_prefix("refresh", settings))
+    conversion_pool = None
+    if not settings.use_track_index:
+        conversion_pool = ThreadPoolExecutor(max_workers=settings.conversion_max_workers, thread_name_prefix=get_thread_name_prefix("conversion", settings))
+        # the playlists waiting for a converter, the scan is held back once they are all taken
+        conversion_slots = threading.BoundedSemaphore(settings.conversion_max_workers * 2)
+    track_index_future = None
+    music_snapshot_future = None
+    deletes_dispatched = False
+    
+    try:
+        with SYNC_METRICS.phase("scan and dispatch"):
+            for operation, playlist_key, playlist_data in playlist_operations:
+                if operation == DELETE_PLAYLISTS:
+                    logger.info("Deleting playlists: {}\n".format(playlist_data))
+                    delete_playlists(playlist_index, playlist_data, executor, journal)
+                    deletes_dispatched = True
+                    continue
+                
+                is_update = operation == UPDATE_PLAYLIST
+                if is_update and any(journal.is_completed(x, playlist_key, playlist_data.size, playlist_data.mtime) for x in (CREATE_OPERATION, UPDATE_OPERATION)):
+                    # only updates, a playlist the interrupted sync created but that is not on plex anymore has to be created again
+                    logger.info("Skipping playlist: %s, the interrupted sync already pushed it\n" % playlist_key)
+                    SYNC_METRICS.count("playlists_resumed")
+                    continue
+                journal.plan(operation, playlist_key, size=playlist_data.size, mtime=playlist_data.mtime)
+                
+                if track_index_future is None and (settings.use_track_index or (is_update and settings.incremental_update)):
+                    track_index_future = shared_work.submit_refresh(refresh_pool, settings.track_index_file, refresh_track_index, plex, music_lib_section, settings)
+                if music_snapshot_future is None and settings.validate_tracks:
+                    music_snapshot_future = shared_work.submit_refresh(refresh_pool, settings.music_snapshot_file, refresh_music_snapshot, settings)
+                
+                logger.info("%s playlist: %s\n" % ("Updating" if is_update else "Creating", playlist_key))
+                playlist_full_path, converted_playlist_full_path = get_playlist_paths(playlist_data.name, playlist_data.folder, settings.unmodified_playlists_dir,
+                                                                                      settings.converted_playlists_dir)
+                playlist_push = PlaylistPush(plex, music_lib_section, playlist_index, playlist_data.name, playlist_data.folder, playlist_full_path, manifest,
+                                             track_index_future, music_snapshot_future, settings)
+                if conversion_pool is None:
+                    submit_playlist_operation(executor, journal, operation, playlist_key, playlist_data, playlist_push)
+                    continue
+                conversion_slots.acquire()
+                conversion_future = conversion_pool.submit(convert_and_submit_playlist, executor, journal, shared_work, operation, playlist_key, playlist_data,
+                                                           playlist_push, converted_playlist_full_path, settings)
+                conversion_future.add_done_callback(lambda _: conversion_slots.release())
+        
+        if not deletes_dispatched:
+            logger.error("Failed to diff removed playlists!\n")
+        if conversion_pool is not None:
+            # the plex operations run while the conversion goes on, this phase ends with the last conversion
+            with SYNC_METRICS.phase("conversion"):
+                conversion_pool.shutdown(wait=True)
+        
+        with SYNC_METRICS.phase("waiting for plex"):
+            failures = executor.wait()
+            refresh_pool.shutdown(wait=True)
+        if music_snapshot_future is not None and music_snapshot_future.exception() is None:
+            music_snapshot = music_snapshot_future.result()
+            if music_snapshot is not None and music_snapshot.missing_tracks:
+                logger.warning("Tracks missing from %s, by playlist:\n%s\n" % (settings.local_music_dir, "\n".join("  %s: %s" % (x, y) for x, y in sorted(music_snapshot.missing_tracks.items()))))
+            if music_snapshot is not None and music_snapshot.unmapped_tracks:
+                logger.warning("Tracks not under %s, by playlist:\n%s\n" % (settings.nvidia_shield_music_dir, "\n".join("  %s: %s" % (x, y) for x, y in sorted(music_snapshot.unmapped_tracks.items()))))
+        if track_index_future is not None and track_index_future.exception() is None:
+            track_index = track_index_future.result()
+            if track_index.unresolved_paths:
+                logger.warning("%d tracks of the synced playlists could not be found in plex:\n%s\n" % (len(track_index.unresolved_paths), "\n".join(sorted(track_index.unresolved_paths))))
+        # with failures, the journal is kept so that a forced sync does not redo what went through
+        synced = not failures
+        return failures
+    finally:
+        if conversion_pool is not None:
+            conversion_pool.shutdown(wait=True, cancel_futures=True)
+        refresh_pool.shutdown(wait=True)
+        # whatever got uploaded before a failure is still recorded, so we don't redo it next time
+        with SYNC_METRICS.phase("manifest save"):
+            manifest.save()
+        journal.close(remove=synced)
+
+
+"""
+Syncs the playlists to every target at the same time, each one with its own diff, from a single scan of the playlists tree.
+The diffs are the ones of iter_logged_playlist_operations when removed_playlists is specified, and the ones of iter_playlist_operations otherwise.
+Returns the plex operations that failed, by target.
+"""
+def sync_targets(targets, force_sync, synced_playlists=None, changed_playlists=None, removed_playlists=None):
+    
+    unmodified_playlists_dir = targets[0].settings.unmodified_playlists_dir
+    shared_work = SharedSyncWork()
+    tree_fan_out = None
+    if synced_playlists is None and removed_playlists is None and len(targets) > 1:
+        if not os.path.isdir(unmodified_playlists_dir):
+            logger.error("%s does not exist or is not a directory!\n", unmodified_playlists_dir)
+            synced_playlists = dict()
+        else:
+            tree_fan_out = PlaylistTreeFanOut(unmodified_playlists_dir, len(targets))
+            tree_fan_out.start()
+    
+    def sync_target(target_id, target):
+        try:
+            if removed_playlists is not None:
+                playlist_operations = iter_logged_playlist_operations(target.playlist_index, unmodified_playlists_dir, target.manifest, force_sync, changed_playlists,
+                                                                      removed_playlists)
+            else:
+                target_playlists = tree_fan_out.consumer(target_id) if tree_fan_out is not None else synced_playlists
+                playlist_operations = iter_playlist_operations(target.playlist_index, unmodified_playlists_dir, target.manifest, force_sync, target_playlists, changed_playlists)
+            return sync_playlists(target.plex, target.music_lib_section, target.playlist_index, target.manifest, target.executor, playlist_operations, target.settings,
+                                  shared_work)
+        finally:
+            if tree_fan_out is not None:
+                tree_fan_out.close(target_id)
+    
+    if len(targets) == 1:
+        return [sync_target(0, targets[0])]
+    
+    def sync_target_thread(target_id, target):
+        threading.current_thread().name = get_thread_name_prefix("sync", target.settings)
+        return sync_target(target_id, target)
+    
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        futures = [pool.submit(sync_target_thread, x, y) for x, y in enumerate(targets)]
+        return [x.result() for x in futures]
+
+
+"""
+Keeps running and syncs the playlists every time a batch of changes lands in the latest playlists folder.
+The plex connections, the playlist indexes and the tree index stay in memory between batches, and only the playlists that changed get converted and pushed.
+"""
+def watch_playlists(targets, settings):
+    
+    from PlaylistTreeWatcher import PlaylistTreeWatcher
+    
+    unmodified_playlists_dir = settings.unmodified_playlists_dir
+    with PlaylistTreeWatcher(unmodified_playlists_dir, settings.watch_debounce_seconds, settings.watch_poll_interval_seconds) as watcher:
+        try:
+            while True:
+                changed_playlists, removed_playlists = watcher.wait_for_changes()
+                logger.info("Detected changes in playlists: {}, removed playlists: {}\n".format(sorted(changed_playlists), sorted(removed_playlists)))
+                targets_failures = sync_targets(targets, False, watcher.playlists, changed_playlists)
+                for target_id, failures in enumerate(targets_failures):
+                    if failures:
+                        # what we think is on plex might be wrong now, start the next batch from a fresh listing
+                        target = targets[target_id]
+                        targets[target_id] = target._replace(playlist_index=PlexPlaylistIndex.fetch(target.plex, target.music_lib_section.key))
+        except KeyboardInterrupt:
+            logger.info("Stopped watching %s\n" % unmodified_playlists_dir)
+
+
+def parse_args():
+    
+    # Instantiate the parser, the defaults come from the settings, so every option is None unless it was given
+    parser = argparse.ArgumentParser(description="Upload playlists to Plex")
+    
+    # Add arguments
+    parser.add_argument("--config", type=str, default=DEFAULT_CONFIG_FILE, help="The json config file, check PlexServerDefaultConfigExample.json")
+    parser.add_argument("-u", "--plex_url", type=str, help="The Plex URL")
+    parser.add_argument("-t", "--plex_token", type=str, help="The Plex Token")
+    parser.add_argument("-s", "--music_lib_section_name", type=str, help="The Plex Music Library Section Name")
+    parser.add_argument("-d", "--playlists_dir", type=str, help="The Playlists Directory Path")
+    parser.add_argument("-i", "--incremental_update", action=argparse.BooleanOptionalAction, help="Update existing playlists in place instead of deleting and recreating them")
+    parser.add_argument("--track_index", action=argparse.BooleanOptionalAction, help="Build the playlists from the ratingKeys of their tracks instead of uploading converted m3u files")
+    parser.add_argument("--validate_tracks", action=argparse.BooleanOptionalAction, help="Check that the tracks of the playlists exist in the music folder before pushing them")
+    parser.add_argument("-w", "--max_workers", type=int, help="The number of Plex requests allowed to run at the same time")
+    parser.add_argument("-c", "--conversion_workers", type=int, help="The number of playlists allowed to be converted at the same time")
+    parser.add_argument("-l", "--from_log", action=argparse.BooleanOptionalAction, help="If added, we only sync the playlists logged by freefilesync since the last run instead of scanning the playlists folder")
+    parser.add_argument("--watch", action=argparse.BooleanOptionalAction, help="If added, we keep running and sync the playlists as soon as they change")
+    parser.add_argument("-f", "--force_sync", action=argparse.BooleanOptionalAction, help="If added, we ignore the sync manifest and update every playlist")
+    parser.add_argument("--metrics_out", "--metrics-out", type=str, help="Where to save the timings, request latencies and counters of the run, as json")
+    parser.add_argument("--profile_out", "--profile-out", type=str, help="If specified, the whole run is profiled with cProfile and the stats are saved there, check them with python -m pstats")
+    
+    return parser.parse_args()
+
+
+"""
+Applies the command line arguments on top of the settings of the json config.
+"""
+def get_settings(args):
+    
+    settings = load_settings(args.config)
+    overrides = dict()
+    for setting_name, setting_label, value in (("plex_url", "Plex URL", args.plex_url),
+                                               ("plex_token", "Plex Token", args.plex_token),
+                                               ("music_lib_section_name", "Music Library Section Name", args.music_lib_section_name),
+                                               ("playlists_dir", "Playlists Directory", args.playlists_dir),
+                                               ("force_sync_all_playlists", "Force Sync All Playlists", args.force_sync),
+                                               ("incremental_update", "Incremental Update", args.incremental_update),
+                                               ("use_track_index", "Track Index", args.track_index),
+                                               ("validate_tracks", "Validate Tracks", args.validate_tracks),
+                                               ("plex_api_max_workers", "Max Workers", args.max_workers),
+                                               ("conversion_max_workers", "Conversion Workers", args.conversion_workers)):
+        if value is not None:
+            overrides[setting_name] = value
+            logger.info("Using {}: {}".format(setting_label, value))
+    
+    return replace(settings, **overrides)
+
+
+"""
+Runs a sync to every target, and keeps watching the playlists afterwards if asked to.
+"""
+def run(args, settings):
+    
+    force_sync = settings.force_sync_all_playlists
+    watch = args.watch
+    try:
+        targets_settings = get_target_settings(settings)
+    except ValueError as exc:
+        logger.error("Invalid targets in {}: {}\n".format(args.config, exc))
         sys.exit(1)
+    if len(targets_settings) > 1:
+        # the log lines of the targets are mixed, they start with the name of the thread that logged them
+        stream_handler.setFormatter(logging.Formatter('%(threadName)s: %(message)s'))
+    
+    log_state = None
+    if args.from_log:
+        log_state = PlaylistEditDetectionAndConversion.FreeFileSyncLogState(settings.free_file_sync_log_state_file, settings.free_file_sync_logs_dir)
+    
+    startup_seconds = time.perf_counter() - STARTUP_TIME
+    SYNC_METRICS.record_phase("startup", startup_seconds)
+    logger.debug("Started in %.3fs\n" % startup_seconds)
+    
+    with ExitStack() as stack:
+        executors = [stack.enter_context(PlexApiExecutor(x.plex_api_max_workers, x.plex_api_max_retries, x.plex_api_retry_backoff_seconds, x.plex_api_max_pending,
+                                                         get_thread_name_prefix("plex_api", x)))
+                     for x in targets_settings]
+        playlist_hashes = dict() # shared by the manifests of all targets
+        with ThreadPoolExecutor(max_workers=len(targets_settings), thread_name_prefix="connect") as pool:
+            targets = list(pool.map(open_sync_target, targets_settings, executors, itertools.repeat(playlist_hashes)))
+        if None in targets:
+            sys.exit(1)
         
-    playlists_to_create = [] 
-    playlists_to_update = [] 
-    playlists_to_remove = []
-    playlists_to_create, playlists_to_update, playlists_to_remove = diff_playlists(plex, music_lib_section.key, unmodified_playlists_dir, force_sync)
+        changed_playlists, removed_playlists = None, None
+        if log_state is not None and not force_sync:
+            with SYNC_METRICS.phase("freefilesync logs"):
+                changed_playlists, removed_playlists = log_state.collect_new_changes()
+        if changed_playlists is not None:
+            logger.info("Using the freefilesync logs, changed playlists: {}, removed playlists: {}\n".format(sorted(changed_playlists), sorted(removed_playlists)))
+        
+        # the diffs are lazy, the playlists tree is scanned while sync_playlists pushes what it finds
+        targets_failures = sync_targets(targets, force_sync, changed_playlists=changed_playlists, removed_playlists=removed_playlists)
+        failures = [y for x in targets_failures for y in x]
+        if log_state is not None and not failures:
+            # only move past the log entries once they made it to every plex server
+            log_state.save()
+        if watch:
+            watch_playlists(targets, settings)
     
-    if playlists_to_create is not None:
-        logger.info("\nCreating playlists: {}\n".format(playlists_to_create))
-        create_or_update_playlists(plex, music_lib_section, playlists_to_create, unmodified_playlists_dir, converted_playlists_dir)
-    else:
-        logger.error("Failed to diff created playlists!\n")
+    if failures and not watch:
+        sys.exit(1)
+
+
+def main():
         
-    if playlists_to_remove is not None:
-        logger.info("Deleting playlists: {}\n".format(playlists_to_remove))
-        delete_playlists(plex, playlists_to_remove)
-    else:
-        logger.error("Failed to diff removed playlists!\n")
+    args = parse_args()
+    settings = get_settings(args)
     
-    if playlists_to_update is not None:
-        logger.info("Updating playlists: {}\n".format(playlists_to_update))
-        delete_playlists(plex, playlists_to_update)
-        create_or_update_playlists(plex, music_lib_section, playlists_to_update, unmodified_playlists_dir, converted_playlists_dir)
-    else:
-        logger.error("Failed to diff updated playlists!\n")
+    profiler = None
+    if args.profile_out:
+        import cProfile
+        profiler = cProfile.Profile()
+    
+    try:
+        if profiler is not None:
+            profiler.runcall(run, args, settings)
+        else:
+            run(args, settings)
+    finally:
+        # also export what we have when the sync failed or the watch was stopped
+        if profiler is not None:
+            profiler.dump_stats(args.profile_out)
+            logger.info("Saved the profile of the run to: {}\n".format(args.profile_out))
+        SYNC_METRICS.log_summary(logger)
+        if args.metrics_out:
+            SYNC_METRICS.save(args.metrics_out)
+            logger.info("Saved the metrics of the run to: {}\n".format(args.metrics_out))
         
         
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,75 @@
+import logging
+import threading
+
+"""
+Class that holds all the audio playlists of a music section in memory, keyed by title and by ratingKey.
+The playlists are listed once and the index is then shared by the diff, delete and update phases,
+and kept up to date as playlists get created and deleted.
+Plex allows several playlists to have the same title, those are reported instead of picking one at random.
+"""
+class PlexPlaylistIndex:
+    def __init__(self, playlists=()):
+        self.by_rating_key = dict() # ratingKey, playlist
+        self.by_title = dict() # title, list of playlists with that title
+        self._lock = threading.Lock()
+        for playlist in playlists:
+            self.add(playlist)
+
+    @classmethod
+    def fetch(cls, plex_server, music_lib_section_id):
+        """ Lists all the audio playlists of the music section with a single request and indexes them. """
+        index = cls(plex_server.playlists(playlistType="audio", sectionId=music_lib_section_id))
+        for title, playlists in index.duplicate_titles().items():
+            logging.warning("Found %d playlists named %s on plex (ratingKeys: %s)\n", len(playlists), title, ", ".join(str(x.ratingKey) for x in playlists))
+        return index
+
+    def __contains__(self, title):
+        return title in self.by_title
+
+    def __len__(self):
+        return len(self.by_rating_key)
+
+    def titles(self) -> set[str]:
+        return set(self.by_title)
+
+    def duplicate_titles(self) -> dict:
+        """ Returns the titles shared by more than one playlist, with the playlists sharing them. """
+        return {x: list(y) for x, y in self.by_title.items() if len(y) > 1}
+
+    def get_all(self, title) -> list:
+        return list(self.by_title.get(title, ()))
+
+    def find(self, title, rating_key=None):
+        """ Returns the playlist with the specified title, or None if there is none or if it is ambiguous.
+
+            Parameters:
+                title (str): Title of the playlist.
+                rating_key: The ratingKey we expect the playlist to have, used to pick the right one among playlists with the same title.
+        """
+        playlists = self.by_title.get(title)
+        if not playlists:
+            return None
+
+        if rating_key is not None:
+            for playlist in playlists:
+                if str(playlist.ratingKey) == str(rating_key):
+                    return playlist
+
+        if len(playlists) > 1:
+            logging.error("There are %d playlists named %s on plex, we don't know which one to use!\n", len(playlists), title)
+            return None
+
+        return playlists[0]
+
+    def add(self, playlist):
+        with self._lock:
+            self.by_rating_key[playlist.ratingKey] = playlist
+            self.by_title.setdefault(playlist.title, []).append(playlist)
+
+    def remove(self, playlist):
+        with self._lock:
+            self.by_rating_key.pop(playlist.ratingKey, None)
+            playlists = self.by_title.get(playlist.title, [])
+            playlists[:] = [x for x in playlists if x.ratingKey != playlist.ratingKey]
+            if not playlists:
+                self.by_title.pop(playlist.title, None)
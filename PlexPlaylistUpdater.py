@@ -0,0 +1,173 @@
+import logging
+from collections import Counter
+
+RATING_KEYS_PER_REQUEST = 500
+
+"""
+Returns the path of the file behind a plex track, as seen by the plex server.
+"""
+def get_track_file(track) -> str:
+    for media in track.media:
+        for part in media.parts:
+            if part.file:
+                return part.file
+    return None
+
+"""
+Returns the positions in <sequence> that are part of its longest increasing subsequence.
+The items at those positions are already in the right relative order, so they never have to be moved.
+"""
+def longest_increasing_subsequence(sequence) -> set[int]:
+    tails = [] # position in sequence of the smallest tail of every increasing subsequence length
+    previous = [-1] * len(sequence)
+    for i, value in enumerate(sequence):
+        low, high = 0, len(tails)
+        while low < high:
+            middle = (low + high) // 2
+            if sequence[tails[middle]] < value:
+                low = middle + 1
+            else:
+                high = middle
+        if low > 0:
+            previous[i] = tails[low - 1]
+        if low == len(tails):
+            tails.append(i)
+        else:
+            tails[low] = i
+
+    positions = set()
+    i = tails[-1] if tails else -1
+    while i != -1:
+        positions.add(i)
+        i = previous[i]
+    return positions
+
+"""
+Diffs the tracks currently in a plex playlist against the ones we want in it.
+Returns the items to remove and the track paths to add (with duplicates, in the order they appear in <new_paths>).
+"""
+def diff_track_lists(current_items, new_paths) -> tuple[list, list[str]]:
+    wanted = Counter(new_paths)
+    kept = Counter()
+    items_to_remove = []
+    for path, item in current_items:
+        if kept[path] < wanted[path]:
+            kept[path] += 1
+        else:
+            items_to_remove.append(item)
+
+    missing = wanted - kept
+    paths_to_add = []
+    for path in new_paths:
+        if missing[path] > 0:
+            missing[path] -= 1
+            paths_to_add.append(path)
+
+    return items_to_remove, paths_to_add
+
+"""
+Returns the (item, item to put it after) moves needed to make the order of <current_items> match <new_paths>.
+Items that have no place in <new_paths> and paths that have no item (e.g. plex failed to add them) are left alone.
+"""
+def compute_track_moves(current_items, new_paths) -> list[tuple]:
+    positions = dict() # path, list of target positions of that path
+    for position, path in enumerate(new_paths):
+        positions.setdefault(path, []).append(position)
+
+    used = Counter()
+    target_order = [None] * len(new_paths)
+    current_positions = []
+    for path, item in current_items:
+        if used[path] >= len(positions.get(path, ())):
+            continue
+        position = positions[path][used[path]]
+        used[path] += 1
+        target_order[position] = item
+        current_positions.append(position)
+
+    stable_positions = {current_positions[i] for i in longest_increasing_subsequence(current_positions)}
+
+    moves = []
+    previous_item = None
+    for position, item in enumerate(target_order):
+        if item is None:
+            continue
+        if position not in stable_positions:
+            moves.append((item, previous_item))
+        previous_item = item
+    return moves
+
+"""
+Fetches the tracks with the specified ratingKeys with a single request, plexapi needs the tracks themselves to build a playlist.
+Returns them in the order of <rating_keys>, duplicates included, plex only returns each track once. Tracks plex did not return are left out.
+"""
+def fetch_tracks(plex_server, rating_keys) -> list:
+    unique_rating_keys = list(dict.fromkeys(int(x) for x in rating_keys))
+    # without a container size, plexapi would page through them 100 at a time
+    tracks = {x.ratingKey: x for x in plex_server.fetchItems(unique_rating_keys, container_size=len(unique_rating_keys))}
+    return [tracks[int(x)] for x in rating_keys if int(x) in tracks]
+
+"""
+Creates an audio playlist straight from the ratingKeys of its tracks, plex doesn't have to read and resolve an m3u file.
+The tracks are fetched and sent in chunks of <chunk_size>, so that the urls stay reasonably short.
+"""
+def create_playlist_from_rating_keys(plex_server, title, rating_keys, chunk_size=RATING_KEYS_PER_REQUEST):
+    from plexapi.playlist import Playlist
+
+    playlist_obj = Playlist.create(plex_server, title, items=fetch_tracks(plex_server, rating_keys[:chunk_size]))
+    add_rating_keys_to_playlist(plex_server, playlist_obj, rating_keys[chunk_size:], chunk_size)
+    return playlist_obj
+
+"""
+Appends tracks to a playlist from their ratingKeys, in chunks of <chunk_size>.
+"""
+def add_rating_keys_to_playlist(plex_server, playlist_obj, rating_keys, chunk_size=RATING_KEYS_PER_REQUEST):
+    for i in range(0, len(rating_keys), chunk_size):
+        tracks = fetch_tracks(plex_server, rating_keys[i:i + chunk_size])
+        if tracks:
+            playlist_obj.addItems(tracks)
+
+"""
+Updates a plex playlist in place so that it contains the tracks of <new_paths> in that order.
+Only the removed, added and moved tracks trigger requests, and the playlist keeps its ratingKey.
+The diff always starts from what is on plex right now, so the same playlist object can be updated several times (watch mode), and an update can be retried after it partly went through.
+Returns the number of changes that were applied.
+"""
+def update_playlist_in_place(plex_server, playlist_obj, new_paths, track_index) -> int:
+    # plexapi caches the items on the object, they would be the ones of the previous update
+    playlist_obj.reload()
+    current_items = [(get_track_file(x), x) for x in playlist_obj.items()]
+    items_to_remove, paths_to_add = diff_track_lists(current_items, new_paths)
+
+    tracks_to_add, unresolved_paths = track_index.resolve(paths_to_add)
+    if unresolved_paths:
+        logging.warning("Could not find %d tracks of %s in plex: %s\n", len(unresolved_paths), playlist_obj.title, unresolved_paths)
+        unresolved = Counter(unresolved_paths)
+        resolved_paths = []
+        for path in new_paths:
+            if unresolved[path] > 0:
+                unresolved[path] -= 1
+            else:
+                resolved_paths.append(path)
+        new_paths = resolved_paths
+
+    if items_to_remove:
+        logging.debug("Removing %d tracks from %s\n", len(items_to_remove), playlist_obj.title)
+        playlist_obj.removeItems(items_to_remove)
+
+    if tracks_to_add:
+        logging.debug("Adding %d tracks to %s\n", len(tracks_to_add), playlist_obj.title)
+        add_rating_keys_to_playlist(plex_server, playlist_obj, tracks_to_add)
+
+    if items_to_remove or tracks_to_add:
+        # we need the playlist item ids of the new items to move them around, reloading drops the cached items
+        playlist_obj.reload()
+        current_items = [(get_track_file(x), x) for x in playlist_obj.items()]
+    moves = compute_track_moves(current_items, new_paths)
+
+    for item, after_item in moves:
+        playlist_obj.moveItem(item, after=after_item)
+    if moves:
+        logging.debug("Moved %d tracks in %s\n", len(moves), playlist_obj.title)
+
+    return len(items_to_remove) + len(tracks_to_add) + len(moves)
@@ -0,0 +1,131 @@
+import os
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+
+from PlexPlaylistUpdater import get_track_file
+from SyncMetrics import SYNC_METRICS
+
+TRACK_INDEX_VERSION = 1
+TRACKS_PER_REQUEST = 1000
+REFRESH_MARGIN_SECONDS = 60 # plex timestamps are in seconds, we look a bit further back so that nothing updated during the last refresh is missed
+
+"""
+Returns the unix timestamp of a plex datetime attribute, or 0 if it is not set.
+"""
+def get_timestamp(value) -> int:
+    return int(value.timestamp()) if value is not None else 0
+
+"""
+Class that maps the file of every track of the music section, as seen by the plex server, to the ratingKey of the track.
+The map is kept in a local sqlite database, so a refresh only asks plex for the tracks added or updated since the previous one,
+and the whole section is only listed again when the number of tracks does not add up anymore (e.g. tracks were deleted).
+Resolving paths only reads the in-memory copy that the refresh loads, so it can be done from several worker threads at once.
+"""
+class PlexTrackIndex:
+    def __init__(self, path):
+        self.path = path
+        self.unresolved_paths = set() # every path we could not resolve since the index was loaded
+        self._rating_keys = dict() # file, ratingKey
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rating_keys)
+
+    def refresh(self, plex_server, music_lib_section):
+        """ Brings the index up to date with the music section and loads it in memory. """
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path)
+        try:
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+                connection.execute("CREATE TABLE IF NOT EXISTS tracks (file TEXT PRIMARY KEY, rating_key INTEGER UNIQUE, updated_at INTEGER)")
+            meta = dict(connection.execute("SELECT key, value FROM meta"))
+
+            # the ratingKeys only mean something for the server and the section they come from
+            source = "%s/%s" % (plex_server.machineIdentifier, music_lib_section.uuid or music_lib_section.key)
+            if meta.get("version") != str(TRACK_INDEX_VERSION) or meta.get("source") != source or "last_updated_at" not in meta:
+                logging.info("Building the track index %s\n", self.path)
+                self._rebuild(connection, music_lib_section, source)
+            elif not self._refresh_incrementally(connection, music_lib_section, int(meta["last_updated_at"])):
+                self._rebuild(connection, music_lib_section, source)
+
+            rating_keys = dict(connection.execute("SELECT file, rating_key FROM tracks"))
+        finally:
+            connection.close()
+
+        with self._lock:
+            self._rating_keys = rating_keys
+
+    def resolve(self, paths) -> tuple[list[int], list[str]]:
+        """ Returns the ratingKeys of the tracks matching <paths> and the paths we could not find in the music section. """
+        rating_keys = []
+        unresolved_paths = []
+        for path in paths:
+            rating_key = self._rating_keys.get(path)
+            if rating_key is None:
+                unresolved_paths.append(path)
+            else:
+                rating_keys.append(rating_key)
+
+        if unresolved_paths:
+            SYNC_METRICS.count("tracks_unresolved", len(unresolved_paths))
+            with self._lock:
+                self.unresolved_paths.update(unresolved_paths)
+        return rating_keys, unresolved_paths
+
+    def _rebuild(self, connection, music_lib_section, source):
+        with SYNC_METRICS.phase("plex tracks listing"):
+            tracks = music_lib_section.searchTracks(container_size=TRACKS_PER_REQUEST)
+        with connection:
+            connection.execute("DELETE FROM tracks")
+            last_updated_at = self._upsert_tracks(connection, tracks)
+            connection.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                   (("version", str(TRACK_INDEX_VERSION)), ("source", source), ("last_updated_at", str(last_updated_at))))
+        logging.info("Indexed %d tracks of %s\n", len(tracks), music_lib_section.title)
+
+    def _refresh_incrementally(self, connection, music_lib_section, last_updated_at) -> bool:
+        """ Applies the tracks added or updated since <last_updated_at>, returns False if the index has to be rebuilt instead. """
+        from plexapi.exceptions import BadRequest, NotFound
+
+        since = datetime.fromtimestamp(max(0, last_updated_at - REFRESH_MARGIN_SECONDS))
+        filters = {"or": [{"track.addedAt>>": since}, {"track.updatedAt>>": since}]}
+        try:
+            with SYNC_METRICS.phase("plex updated tracks listing"):
+                tracks = music_lib_section.searchTracks(filters=filters, container_size=TRACKS_PER_REQUEST)
+        except (BadRequest, NotFound) as exc:
+            logging.warning("Could not list the tracks updated since %s, rebuilding the track index: %s\n", since, exc)
+            return False
+
+        with connection:
+            last_updated_at = max(last_updated_at, self._upsert_tracks(connection, tracks))
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", ("last_updated_at", str(last_updated_at)))
+        indexed_count = connection.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+        # deleted tracks don't show up as updated, the count is how we notice them
+        with SYNC_METRICS.phase("plex updated tracks listing"):
+            track_count = music_lib_section.totalViewSize(libtype="track")
+        if indexed_count != track_count:
+            logging.info("The track index has %d tracks but %s has %d, rebuilding it\n", indexed_count, music_lib_section.title, track_count)
+            return False
+
+        logging.debug("Refreshed %d tracks of the track index\n", len(tracks))
+        return True
+
+    def _upsert_tracks(self, connection, tracks) -> int:
+        """ Writes the tracks to the index and returns the most recent added/updated timestamp among them. """
+        rows = []
+        last_updated_at = 0
+        for track in tracks:
+            track_file = get_track_file(track)
+            if not track_file:
+                continue
+            updated_at = max(get_timestamp(track.addedAt), get_timestamp(track.updatedAt))
+            last_updated_at = max(last_updated_at, updated_at)
+            rows.append((track_file, int(track.ratingKey), updated_at))
+
+        # a track that was moved comes back with a new file, its old one has to go
+        connection.executemany("DELETE FROM tracks WHERE rating_key = ?", ((x[1],) for x in rows))
+        connection.executemany("INSERT OR REPLACE INTO tracks (file, rating_key, updated_at) VALUES (?, ?, ?)", rows)
+        return last_updated_at
@@ -0,0 +1,47 @@
+import threading
+from concurrent.futures import Future
+
+from PlaylistEditDetectionAndConversion import try_convert_playlist_for_plex
+from SyncMetrics import SYNC_METRICS
+
+"""
+Class that holds the work the plex servers of a sync round can share, so that it is only done once however many servers we push to:
+the conversion of each playlist, per converted file, and the background refreshes, such as the music snapshot, per state file.
+Targets that share a converted playlists folder also share their path rewrite rules (see get_target_settings), so a converted file is the same for all of them.
+"""
+class SharedSyncWork:
+    def __init__(self):
+        self._conversions = dict() # converted playlist path, ((size, mtime) of the playlist, future of the conversion)
+        self._refreshes = dict() # state file, future of the refresh
+        self._lock = threading.Lock()
+
+    def convert_playlist(self, playlist_file_path, target_file_path, path_rewriter, size, mtime):
+        """ Same as try_convert_playlist_for_plex, if another target already converted this version of the playlist we wait for its result instead. """
+        with self._lock:
+            conversion = self._conversions.get(target_file_path)
+            is_owner = conversion is None or conversion[0] != (size, mtime)
+            if is_owner:
+                conversion = ((size, mtime), Future())
+                self._conversions[target_file_path] = conversion
+
+        future = conversion[1]
+        if not is_owner:
+            SYNC_METRICS.count("conversions_shared")
+            return future.result()
+
+        try:
+            result = try_convert_playlist_for_plex(playlist_file_path, target_file_path, path_rewriter)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        future.set_result(result)
+        return result
+
+    def submit_refresh(self, pool, state_file, fn, *args) -> Future:
+        """ Submits fn(*args) to the pool, unless a refresh of the same state file was already submitted, whose future is returned instead. """
+        with self._lock:
+            future = self._refreshes.get(state_file)
+            if future is None:
+                future = pool.submit(fn, *args)
+                self._refreshes[state_file] = future
+        return future
@@ -0,0 +1,101 @@
+import re
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+REGEX_URL_ID_SEGMENT = re.compile(r"/\d+(?:(?:,|%2C)\d+)*(?=/|$)") # a single id or a list of them, e.g. /library/metadata/1,2,3
+
+"""
+Returns the endpoint a request path belongs to, with its query dropped and its ids replaced, e.g. DELETE /playlists/{id}.
+"""
+def get_endpoint(method, path) -> str:
+    return "%s %s" % (method, REGEX_URL_ID_SEGMENT.sub("/{id}", path.split("?", 1)[0]))
+
+"""
+Class that collects what a sync spends its time on: the wall time of each phase, the latency of every plex request by endpoint,
+and counters such as the bytes read and written or the playlists created, updated, deleted and skipped.
+Everything can be recorded from several worker threads at once, and exported as json with save().
+"""
+class SyncMetrics:
+    def __init__(self):
+        self.phases = dict() # phase, seconds
+        self.counters = dict() # counter, value
+        self.request_latencies = dict() # endpoint, list of seconds
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """ Times the code of the with block, phases that run several times add up. """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(name, time.perf_counter() - start_time)
+
+    def record_phase(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_request(self, method, path, seconds):
+        endpoint = get_endpoint(method, path)
+        with self._lock:
+            self.request_latencies.setdefault(endpoint, []).append(seconds)
+
+    def install_session_hook(self, session):
+        """ Records the latency of every request made through the requests session. """
+        def on_response(response, *args, **kwargs):
+            self.record_request(response.request.method, response.request.path_url, response.elapsed.total_seconds())
+        session.hooks["response"].append(on_response)
+
+    def reset(self):
+        with self._lock:
+            self.phases = dict()
+            self.counters = dict()
+            self.request_latencies = dict()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            phases = dict(self.phases)
+            counters = dict(self.counters)
+            request_latencies = {x: sorted(y) for x, y in self.request_latencies.items()}
+
+        requests = dict()
+        for endpoint, latencies in request_latencies.items():
+            histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+            for latency in latencies:
+                histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, latency * 1000)] += 1
+            histogram_labels = ["<=%dms" % x for x in LATENCY_BUCKETS_MS] + [">%dms" % LATENCY_BUCKETS_MS[-1]]
+            requests[endpoint] = {
+                "count": len(latencies),
+                "total_seconds": sum(latencies),
+                "p50_ms": latencies[len(latencies) // 2] * 1000,
+                "p95_ms": latencies[min(len(latencies) - 1, len(latencies) * 95 // 100)] * 1000,
+                "max_ms": latencies[-1] * 1000,
+                "histogram": {x: y for x, y in zip(histogram_labels, histogram) if y},
+            }
+
+        return {"phases": phases, "counters": counters, "requests": requests}
+
+    def save(self, path):
+        with open(path, mode="w", encoding="utf-8") as json_file:
+            json.dump(self.to_dict(), json_file, indent=1, sort_keys=True)
+
+    def log_summary(self, logger=logging):
+        data = self.to_dict()
+        logger.debug("Phases: %s\n" % ", ".join("%s %.3fs" % (x, y) for x, y in data["phases"].items()))
+        logger.debug("Counters: %s\n" % ", ".join("%s %d" % (x, y) for x, y in sorted(data["counters"].items())))
+        for endpoint, stats in sorted(data["requests"].items()):
+            logger.debug("%s: %d requests, p50 %.1fms, p95 %.1fms, max %.1fms\n" % (endpoint, stats["count"], stats["p50_ms"], stats["p95_ms"], stats["max_ms"]))
+
+"""
+The metrics of the current run, shared by every module the way the loggers are.
+"""
+SYNC_METRICS = SyncMetrics()